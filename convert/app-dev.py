@@ -3,8 +3,22 @@ import hmac
 import logging
 import re
 import importlib
+from functools import partial
 from pathlib import Path
-from flask import Flask, request, abort
+from typing import Dict
+from urllib.parse import unquote
+from flask import Flask, jsonify, request, abort
+
+import clash
+from keywords import KeywordMatcher
+from probe import LatencyProber
+from prerender import start_prerender, warm_up
+from render_cache import RenderCache
+import timing
+from upstream import SubscriptionStore
+
+# Imported at startup, not on the first request (module name has a dash)
+singbox = importlib.import_module("sing-box")
 
 # ================= Config =================
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
@@ -15,8 +29,17 @@ BASE_DIR = Path(__file__).resolve().parent
 CACHE_DIR = BASE_DIR / "cache"
 CACHE_DIR.mkdir(exist_ok=True)
 CACHE_EXPIRE_SECONDS = 86400
+# Render every source x profile into cache/prerender in the background and
+# answer requests with those files (also servable by nginx)
+ENABLE_PRERENDER = False
+RENDER_CACHE = RenderCache(
+    CACHE_DIR / "render", CACHE_DIR / "prerender" if ENABLE_PRERENDER else None
+)
+SUBSCRIPTIONS = SubscriptionStore(CACHE_DIR, CACHE_EXPIRE_SECONDS)
 
 SOURCE_MAP = {"mitce": BASE_DIR / "mitce", "bajie": BASE_DIR / "bajie"}
+# Serves every SOURCE_MAP provider merged into one config
+MERGED_SOURCE = "all"
 CUSTOM_CLASH_NODE = BASE_DIR / "node.yaml"
 CUSTOM_SINGBOX_NODE = BASE_DIR / "node.json"
 TARGET_GROUPS = ["Google"]
@@ -51,10 +74,20 @@ SHARED_EXCLUDE_KEYWORDS = [
     "HK5-HY2",
 ]
 
+NODE_FILTER = KeywordMatcher(SHARED_KEYWORDS, SHARED_EXCLUDE_KEYWORDS)
+
 ENABLE_CLASH = True
 ENABLE_SINGBOX = False
+# Probe node TCP latency from this host: fastest first, dead nodes dropped
+ENABLE_PROBE = False
+PROBER = LatencyProber(ttl=300, timeout=1.5, concurrency=64)
+
+# Unauthenticated, for the container health check
+READY_PATH = "/ready"
 
 app = Flask(__name__)
+# Server-Timing header, per-request timing log line and /metrics
+timing.init_app(app, skip_paths=[READY_PATH])
 
 
 # ================= Utils =================
@@ -75,10 +108,62 @@ def clean_node_name(name: str) -> str:
     return re.sub(r"\s+", " ", name).strip()
 
 
+def start_refresher():
+    # Keep every source warm ahead of expiry, off the request path
+    SUBSCRIPTIONS.start_refresher(
+        {
+            name: (lambda path=path: unquote(read_url_from_file(path)))
+            for name, path in SOURCE_MAP.items()
+        }
+    )
+
+
+start_refresher()
+
+
 # ================= Routing & Dispatch =================
+ALLOWED_PATHS = {f"/{name}" for name in [*SOURCE_MAP, MERGED_SOURCE, "metrics"]}
+
+
+def provider_urls() -> Dict[str, str]:
+    # name -> upstream URL for every provider configured on this host
+    urls = {}
+    for name, path in SOURCE_MAP.items():
+        if not path.exists():
+            # Provider not configured on this host
+            continue
+        try:
+            urls[name] = unquote(read_url_from_file(path))
+        except Exception as e:
+            logger.warning(f"Provider skipped [{name}]: {e}")
+    return urls
+
+
+def node_loader(source: str, is_force_refresh: bool, rebuild_nodes: bool):
+    # Zero-argument callable the converters use to get (source_hash, nodes)
+    if source != MERGED_SOURCE:
+        url = unquote(read_url_from_file(SOURCE_MAP[source]))
+        load = lambda: SUBSCRIPTIONS.nodes(  # noqa: E731
+            source, url, is_force_refresh, rebuild_nodes
+        )
+    else:
+        urls = provider_urls()
+        if not urls:
+            raise ValueError("No provider URLs configured")
+        load = lambda: SUBSCRIPTIONS.merged_nodes(  # noqa: E731
+            urls, is_force_refresh, rebuild_nodes
+        )
+
+    if ENABLE_PROBE:
+        return lambda: PROBER.ranked(*load())
+    return load
+
+
 @app.before_request
 def restrict_paths():
-    if request.path not in {"/mitce", "/bajie"}:
+    if request.path == READY_PATH:
+        return
+    if request.path not in ALLOWED_PATHS:
         abort(404)
     if not (key := request.args.get("key")):
         abort(404)
@@ -90,56 +175,137 @@ def restrict_paths():
 
 @app.route("/<source>")
 def process_source(source):
-    path = SOURCE_MAP.get(source)
-    if not path:
+    if source != MERGED_SOURCE and source not in SOURCE_MAP:
         abort(404)
 
     ua = request.headers.get("User-Agent", "")
     is_force_refresh = "u" in request.args
+    # Re-parse the cached subscription into cache/{source}_nodes.jsonl
+    rebuild_nodes = "rebuild" in request.args
 
     try:
-        url = read_url_from_file(path)
+        load_nodes = node_loader(source, is_force_refresh, rebuild_nodes)
     except Exception as e:
         return str(e), 500
 
     if ENABLE_SINGBOX and any(k in ua for k in ["SFA", "sing-box"]):
-        sb_module = importlib.import_module("sing-box")
-        return sb_module.handle_request(
+        return singbox.handle_request(
             source,
-            url,
             ua,
             is_force_refresh,
-            CACHE_DIR,
-            CACHE_EXPIRE_SECONDS,
-            SHARED_KEYWORDS,
-            SHARED_EXCLUDE_KEYWORDS,
+            rebuild_nodes,
+            load_nodes,
+            NODE_FILTER,
             clean_node_name,
             CUSTOM_SINGBOX_NODE,
             TARGET_GROUPS,
             INJECT_TEMPLATES,
+            RENDER_CACHE,
         )
 
     if ENABLE_CLASH and ("Clash" in ua or "clash" in ua):
-        import clash
-
         return clash.handle_request(
             source,
-            url,
             ua,
             is_force_refresh,
-            CACHE_DIR,
-            CACHE_EXPIRE_SECONDS,
-            SHARED_KEYWORDS,
-            SHARED_EXCLUDE_KEYWORDS,
+            rebuild_nodes,
+            load_nodes,
+            NODE_FILTER,
             clean_node_name,
             CUSTOM_CLASH_NODE,
             TARGET_GROUPS,
             INJECT_TEMPLATES,
             BASE_DIR,
+            RENDER_CACHE,
         )
 
     abort(404)
 
 
+def load_current_nodes(source: str):
+    # Loader resolved per pass so edits to the URL files are picked up
+    return node_loader(source, False, False)()
+
+
+def render_jobs(publish: bool):
+    # One job per source x enabled converter profile; `publish` also writes
+    # the result to cache/prerender, otherwise it only fills the render cache
+    converters = []
+    if ENABLE_CLASH:
+        converters.append(
+            (
+                "clash",
+                "yaml",
+                clash,
+                clash.CLASH_PROFILES,
+                [
+                    NODE_FILTER,
+                    clean_node_name,
+                    CUSTOM_CLASH_NODE,
+                    INJECT_TEMPLATES,
+                    BASE_DIR,
+                    RENDER_CACHE,
+                ],
+            )
+        )
+    if ENABLE_SINGBOX:
+        converters.append(
+            (
+                "singbox",
+                "json",
+                singbox,
+                singbox.SB_TEMPLATE_MAP,
+                [
+                    NODE_FILTER,
+                    clean_node_name,
+                    CUSTOM_SINGBOX_NODE,
+                    TARGET_GROUPS,
+                    INJECT_TEMPLATES,
+                    RENDER_CACHE,
+                ],
+            )
+        )
+
+    jobs = {}
+    configured = [name for name, path in SOURCE_MAP.items() if path.exists()]
+    for source in [*configured, MERGED_SOURCE]:
+        load = partial(load_current_nodes, source)
+        for kind, ext, module, profiles, args in converters:
+            for profile in profiles:
+                slot = (source, kind, profile)
+                render = partial(module.render_config, source, profile, load, *args)
+                if publish:
+                    job = partial(RENDER_CACHE.prerender, slot, ext, render)
+                else:
+                    job = partial(RENDER_CACHE.render, slot, render)
+                jobs[f"{source}/{kind}-{profile}"] = job
+    return jobs
+
+
+# ================= Startup =================
+# Each gunicorn worker warms up while importing the app, i.e. before it
+# accepts connections: templates parsed, nodes loaded, every config rendered
+# (from the on-disk caches after a restart). Workers recycled by
+# max_requests or a template HUP come up warm the same way. Upstreams with
+# no cached copy are fetched once, in parallel, up front. A worker that
+# finds another one mid-fetch waits for it and takes its outcome, and one
+# that failed leaves a backoff the others honour, so a down upstream is
+# tried once per boot rather than once per worker and render.
+SUBSCRIPTIONS.prefetch(provider_urls())
+WARM_UP_FAILED = warm_up(render_jobs(publish=False))
+
+
+@app.route(READY_PATH)
+def ready():
+    # WARM_UP_FAILED shrinks as warm_up's retries succeed
+    if WARM_UP_FAILED:
+        return jsonify({"ready": False, "failed": WARM_UP_FAILED}), 503
+    return jsonify({"ready": True})
+
+
+if ENABLE_PRERENDER:
+    start_prerender(render_jobs(publish=True), CACHE_DIR / "prerender.lock")
+
+
 if __name__ == "__main__":
     app.run(port=5000, host="0.0.0.0")
@@ -0,0 +1,290 @@
+import argparse
+import base64
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import yaml
+from flask import Flask
+
+import clash
+import uri_parser
+from keywords import KeywordMatcher
+from render_cache import RenderCache
+from upstream import SubscriptionStore
+from uri_parser import parse_subscription
+
+BASE_DIR = Path(__file__).resolve().parent
+singbox = importlib.import_module("sing-box")
+
+REGIONS = [
+    "香港",
+    "美国",
+    "新加坡",
+    "日本",
+    "United States",
+    "Japan",
+    "官网",
+    "Australia",
+]
+CLASH_UA = {
+    "m": "clash_m",
+    "mtun": "ClashMetaForAndroid",
+    "pc": "clash_pc",
+    "openwrt": "clash_openwrt",
+}
+NODE_FILTER = KeywordMatcher(
+    [
+        "US",
+        "HK",
+        "SG",
+        "JP",
+        "香港",
+        "美国",
+        "新加坡",
+        "日本",
+        "United States",
+        "Japan",
+    ],
+    ["官网", "Australia"],
+)
+SOURCE = "bench"
+
+
+# ================= Synthetic Subscription =================
+def make_uri_text(count: int) -> str:
+    # vless / vmess / trojan / hysteria2 / ss, roughly what providers ship
+    lines = []
+    for i in range(count):
+        name = f"{REGIONS[i % len(REGIONS)]} {i:05d}"
+        host = f"n{i}.example.com"
+        kind = i % 5
+        if kind == 0:
+            lines.append(
+                f"vless://uuid-{i}@{host}:443?security=reality&sni={host}"
+                f"&fp=chrome&pbk=key&sid=ab&type=tcp&flow=xtls-rprx-vision#{name}"
+            )
+        elif kind == 1:
+            vmess = {"ps": name, "add": host, "port": "443", "id": f"id-{i}"}
+            vmess.update({"net": "ws", "path": "/ws", "tls": "tls", "sni": host})
+            blob = base64.b64encode(json.dumps(vmess).encode("utf-8")).decode()
+            lines.append(f"vmess://{blob}")
+        elif kind == 2:
+            lines.append(f"trojan://pw{i}@{host}:443?sni={host}#{name}")
+        elif kind == 3:
+            lines.append(
+                f"hysteria2://pw{i}@{host}:{20000 + i % 1000}?sni={host}"
+                f"&obfs=salamander&obfs-password=ob#{name}"
+            )
+        else:
+            userinfo = base64.urlsafe_b64encode(f"aes-128-gcm:pw{i}".encode()).decode()
+            lines.append(f"ss://{userinfo.rstrip('=')}@{host}:8388#{name}")
+    return "\n".join(lines)
+
+
+def make_subscription(count: int) -> str:
+    # Provider body: the URI list, base64 encoded
+    return base64.b64encode(make_uri_text(count).encode("utf-8")).decode("ascii")
+
+
+# ================= Reference Pipeline =================
+class _FlowDict(dict):
+    pass
+
+
+yaml.add_representer(
+    _FlowDict,
+    lambda d, data: d.represent_mapping("tag:yaml.org,2002:map", data, True),
+)
+
+
+def _flow(data):
+    if isinstance(data, dict):
+        return {k: _flow(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_FlowDict(_flow(i)) if isinstance(i, dict) else _flow(i) for i in data]
+    return data
+
+
+def _dump(data) -> bytes:
+    return yaml.dump(
+        data,
+        allow_unicode=True,
+        sort_keys=False,
+        default_flow_style=False,
+        width=float("inf"),
+    ).encode("utf-8")
+
+
+def render_legacy(config: dict) -> bytes:
+    # Old handle_request: dump -> load -> (inject: dump -> load) -> dump
+    data = yaml.safe_load(_dump(_flow(config)))
+    data = yaml.safe_load(_dump(_flow(data)))
+    return yaml.dump(
+        clash.final_format_data(data),
+        Dumper=yaml.Dumper,
+        allow_unicode=True,
+        sort_keys=False,
+        default_flow_style=False,
+        width=float("inf"),
+    ).encode("utf-8")
+
+
+# ================= Runner =================
+def measure(fn: Callable[[], object], rounds: int, nodes: int) -> Dict[str, float]:
+    fn()  # warm-up: imports, template load, regex compile
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    # Separate pass: tracemalloc slows the timed code down
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples.sort()
+    mean = statistics.fmean(samples)
+    return {
+        "rounds": rounds,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+        "mean_ms": mean * 1000,
+        "ops_per_s": 1 / mean,
+        "nodes_per_s": nodes / mean,
+        "peak_mem_mb": peak / 2**20,
+    }
+
+
+def scenarios(count: int, work_dir: Path, legacy: bool) -> Dict[str, Callable]:
+    raw_b64 = make_subscription(count)
+    store = SubscriptionStore(work_dir, cache_expire=10**9)
+    (work_dir / f"{SOURCE}_uris.txt").write_text(raw_b64, encoding="utf-8")
+    nodes = parse_subscription(raw_b64)
+    app = Flask("bench")
+    render_cache = RenderCache(work_dir / "render")
+    misses = iter(range(10**9))
+    # 1% of the nodes renamed: what a typical provider update changes
+    edited = [
+        n.copy(name=f"{n.name} new") if i % 100 == 0 else n for i, n in enumerate(nodes)
+    ]
+    flips = iter(range(10**9))
+
+    def parse():
+        uri_parser._parse_cache.clear()
+        return parse_subscription(raw_b64)
+
+    def cold_loader():
+        # A fresh hash per call keeps every request a render-cache miss, and
+        # no build state makes it a full build
+        clash.BUILDS.clear()
+        return f"miss-{next(misses)}", nodes
+
+    def edit_loader():
+        # Render-cache miss that differs from the last build by 1% of nodes
+        flip = next(flips)
+        return f"edit-{flip}", edited if flip % 2 else nodes
+
+    found = {"parse": parse}
+    for template in sorted((BASE_DIR / "yaml").glob("*.yaml")):
+        profile = template.stem
+
+        def process(template=template):
+            return clash.process_yaml_content_clash(
+                nodes, template, "50", "200", NODE_FILTER, str.strip
+            )
+
+        def request(profile=profile, loader=cold_loader):
+            with app.test_request_context(headers={"User-Agent": CLASH_UA[profile]}):
+                response = clash.handle_request(
+                    SOURCE,
+                    CLASH_UA[profile],
+                    False,
+                    False,
+                    loader,
+                    NODE_FILTER,
+                    str.strip,
+                    BASE_DIR / "node.yaml",
+                    ["Google"],
+                    ["m", "openwrt"],
+                    BASE_DIR,
+                    render_cache,
+                )
+                response.direct_passthrough = False
+                return response.get_data()
+
+        found[f"clash_process/{profile}"] = process
+        found[f"clash_request/{profile}"] = request
+        found[f"clash_incremental/{profile}"] = partial(request, loader=edit_loader)
+        if legacy:
+            found[f"clash_legacy/{profile}"] = lambda p=process: render_legacy(p())
+
+    for profile in sorted(singbox.SB_TEMPLATE_MAP):
+
+        def singbox_run(profile=profile):
+            return singbox.dump_singbox(
+                singbox.fetch_and_process_singbox(
+                    SOURCE, profile, False, "", store, NODE_FILTER, str.strip
+                )
+            )
+
+        found[f"singbox/{profile}"] = singbox_run
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert pipeline benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--only", default="", help="substring filter on scenarios")
+    parser.add_argument("--legacy", action="store_true", help="include old YAML path")
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "convert-bench-results.json",
+    )
+    args = parser.parse_args()
+    args.out = args.out.resolve()
+    # sing-box template paths are relative to the service directory
+    os.chdir(BASE_DIR)
+
+    results: List[dict] = []
+    for count in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for name, fn in scenarios(count, Path(work_dir), args.legacy).items():
+                if args.only not in name:
+                    continue
+                stats = measure(fn, args.rounds, count)
+                results.append({"scenario": name, "nodes": count, **stats})
+                print(
+                    f"{name:24} {count:6d} nodes  p50 {stats['p50_ms']:9.2f} ms"
+                    f"  p99 {stats['p99_ms']:9.2f} ms"
+                    f"  {stats['nodes_per_s']:10.0f} nodes/s"
+                    f"  peak {stats['peak_mem_mb']:7.1f} MB"
+                )
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "yaml_backend": clash.YamlDumper.__name__,
+        "json_backend": "orjson" if singbox.orjson is not None else "json",
+        "results": results,
+    }
+    args.out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Saved {len(results)} results to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,70 @@
-import base64
-import io
 import logging
-import os
-import re
-import time
-import json
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
-from urllib.parse import urlparse, parse_qs, unquote
-import requests
+from typing import Any, Dict, List, Optional, Tuple
 import yaml
-from flask import send_file, abort
+from flask import abort
+
+from group_filter import GroupFilter
+from group_graph import prune_groups
+from incremental import BuildState, BuildStates
+from keywords import KeywordMatcher
+from render_cache import CODE_FILES, Rendered, source_file
+from shaping import (
+    NO_SHAPING,
+    Shaping,
+    cap_regions,
+    drop_defaults,
+    drop_ungrouped,
+    region_classifier,
+    top_members,
+)
+from templates import TemplateRegistry
+from timing import count, stage
+from uri_parser import CLASH_EMITTERS, Node, unique_names
 
 logger = logging.getLogger(__name__)
 
-CLASH_USER_AGENT = (
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0"
-)
 CLASH_FINGERPRINT = "firefox"
+# Valid proxy-group targets besides nodes and groups; GCP-outbound is the
+# custom node injected after the groups are built
+CLASH_BUILTIN_TARGETS = {"DIRECT", "REJECT", "PASS", "REJECT-DROP", "GCP-outbound"}
+
+# Prefer the libyaml bindings; fall back to pure Python when unavailable
+try:
+    from yaml import CDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import Dumper as YamlDumper, SafeLoader as YamlLoader
+
+# CDumper needs an integer width; large enough to never wrap
+YAML_WIDTH = 1 << 20
+
+
+def load_clash_template(path: Path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.load(f, Loader=YamlLoader)
+    if not isinstance(data, dict):
+        raise ValueError(f"Template is not a mapping: {path}")
+    groups = data.get("proxy-groups", [])
+    if not isinstance(groups, list) or not all(
+        isinstance(g, dict) and "name" in g for g in groups
+    ):
+        raise ValueError(f"Invalid proxy-groups in template: {path}")
+    return data
 
 
-# Force flow style
-class FlowDict(dict):
-    pass
-
-
-def flow_representer(dumper, data):
-    return dumper.represent_mapping("tag:yaml.org,2002:map", data, flow_style=True)
-
-
-yaml.add_representer(FlowDict, flow_representer)
-
-
-# Recursively apply FlowDict only to dictionaries inside lists
-def process_data(data):
-    if isinstance(data, dict):
-        return {k: process_data(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [
-            (
-                FlowDict({k: process_data(v) for k, v in i.items()})
-                if isinstance(i, dict)
-                else process_data(i)
-            )
-            for i in data
-        ]
-    return data
+def compile_clash_filters(data: dict) -> GroupFilter:
+    return GroupFilter(
+        (g["name"], [g["filter"]])
+        for g in data.get("proxy-groups", [])
+        if "filter" in g
+    )
 
 
-def filter_node_names_clash(
-    proxies: List[Any], shared_kw: List[str], shared_ex_kw: List[str]
-) -> Tuple[List[str], List[str]]:
-    all_names = [
-        str(p.get("name"))
-        for p in proxies
-        if isinstance(p, dict) and isinstance(p.get("name"), str)
-    ]
-    valid_kw = [str(kw).lower() for kw in shared_kw if isinstance(kw, str)]
-    valid_ex_kw = [str(ex).lower() for ex in shared_ex_kw if isinstance(ex, str)]
-    filtered = [
-        n
-        for n in all_names
-        if any(kw in n.lower() for kw in valid_kw)
-        and not any(ex in n.lower() for ex in valid_ex_kw)
-    ]
-    return filtered, all_names
+TEMPLATES = TemplateRegistry(load_clash_template, compile_clash_filters)
+# Last build per (source, "clash", profile), for incremental rebuilds
+BUILDS = BuildStates()
 
 
 def process_proxy_config_clash(proxy: Dict[str, Any], up_pref: str, down_pref: str):
@@ -89,280 +89,121 @@ def process_proxy_config_clash(proxy: Dict[str, Any], up_pref: str, down_pref: s
             proxy["client-fingerprint"] = CLASH_FINGERPRINT
 
 
-def parse_uris_to_proxies(text: str) -> dict:
-    proxies = []
-    for line in text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-
-        try:
-            if line.startswith("vless://"):
-                parsed = urlparse(line)
-                uuid, server_port = parsed.netloc.split("@")
-                server, port = server_port.split(":")
-                qs = parse_qs(parsed.query)
-                name = (
-                    unquote(parsed.fragment) if parsed.fragment else f"vless-{server}"
-                )
-
-                proxy = {
-                    "name": name,
-                    "type": "vless",
-                    "server": server,
-                    "port": int(port),
-                    "uuid": uuid,
-                    "udp": True,
-                    "tls": qs.get("security", [""])[0] in ("tls", "reality"),
-                }
-
-                if proxy["tls"]:
-                    proxy["servername"] = qs.get("sni", [server])[0]
-                    if "fp" in qs:
-                        proxy["client-fingerprint"] = qs["fp"][0]
-                    if qs.get("security", [""])[0] == "reality":
-                        proxy["reality-opts"] = {"public-key": qs.get("pbk", [""])[0]}
-                        if "sid" in qs:
-                            proxy["reality-opts"]["short-id"] = qs["sid"][0]
-
-                network = qs.get("type", ["tcp"])[0]
-                proxy["network"] = network
-
-                if network == "ws":
-                    proxy["ws-opts"] = {
-                        "path": qs.get("path", ["/"])[0],
-                        "headers": {"Host": qs.get("host", [server])[0]},
-                    }
-                elif network == "grpc":
-                    proxy["grpc-opts"] = {
-                        "grpc-service-name": qs.get("serviceName", [""])[0]
-                    }
-                proxies.append(proxy)
-
-            elif line.startswith("vmess://"):
-                b64_str = line[8:]
-                b64_str += "=" * ((4 - len(b64_str) % 4) % 4)
-                v_json = json.loads(base64.b64decode(b64_str).decode("utf-8"))
-                proxy = {
-                    "name": unquote(v_json.get("ps", f"vmess-{v_json.get('add')}")),
-                    "type": "vmess",
-                    "server": v_json.get("add"),
-                    "port": int(v_json.get("port")),
-                    "uuid": v_json.get("id"),
-                    "alterId": int(v_json.get("aid", 0)),
-                    "cipher": v_json.get("scy", "auto"),
-                    "udp": True,
-                }
-                if v_json.get("tls") == "tls":
-                    proxy["tls"] = True
-                    if v_json.get("sni"):
-                        proxy["servername"] = v_json.get("sni")
-                    if v_json.get("fp"):
-                        proxy["client-fingerprint"] = v_json.get("fp")
-
-                network = v_json.get("net", "tcp")
-                proxy["network"] = network
-
-                if network == "ws":
-                    proxy["ws-opts"] = {
-                        "path": v_json.get("path", "/"),
-                        "headers": {"Host": v_json.get("host", v_json.get("add"))},
-                    }
-                elif network == "grpc":
-                    proxy["grpc-opts"] = {"grpc-service-name": v_json.get("path", "")}
-                proxies.append(proxy)
-
-            elif line.startswith("trojan://") or line.startswith("hysteria2://"):
-                parsed = urlparse(line)
-                password, server_port = parsed.netloc.split("@")
-                server, port = server_port.split(":")
-                qs = parse_qs(parsed.query)
-                name = (
-                    unquote(parsed.fragment) if parsed.fragment else f"proxy-{server}"
-                )
-                p_type = "trojan" if line.startswith("trojan") else "hysteria2"
-
-                proxy = {
-                    "name": name,
-                    "type": p_type,
-                    "server": server,
-                    "port": int(port),
-                    "password": password,
-                    "udp": True,
-                }
-                if "sni" in qs:
-                    proxy["sni"] = qs["sni"][0]
-
-                if p_type == "hysteria2":
-                    if "obfs" in qs:
-                        proxy["obfs"] = qs["obfs"][0]
-                    if "obfs-password" in qs:
-                        proxy["obfs-password"] = qs["obfs-password"][0]
-
-                proxies.append(proxy)
-
-        except Exception as e:
-            logger.warning(f"Parse Error for node {line[:30]}...: {e}")
-
-    return {"proxies": proxies}
-
-
-def fetch_uris_text(
-    url: str, source_name: str, force_refresh: bool, cache_dir: Path, cache_expire: int
-):
-    # Cache raw base64 content
-    cache_file = cache_dir / f"{source_name}_uris.txt"
-
-    # Helper to decode base64
-    def decode_base64_content(b64_str: str) -> str:
-        b64_str = re.sub(r"\s+", "", b64_str)
-        b64_str = b64_str.replace("-", "+").replace("_", "/")
-        padding = len(b64_str) % 4
-        if padding != 0:
-            b64_str += "=" * (4 - padding)
-        decoded_bytes = base64.b64decode(b64_str)
-        return (
-            decoded_bytes.decode("utf-8", errors="ignore")
-            .lstrip("\ufeff")
-            .replace("\r\n", "\n")
-        )
-
-    if not force_refresh and cache_file.exists():
-        try:
-            if time.time() - os.path.getmtime(cache_file) < cache_expire:
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    return decode_base64_content(f.read())
-        except Exception:
-            pass
-
-    try:
-        res = requests.get(url, headers={"User-Agent": CLASH_USER_AGENT}, timeout=15)
-        res.raise_for_status()
-
-        raw_b64 = res.text.strip()
-
-        # Save raw base64 to disk
-        with open(cache_file, "w", encoding="utf-8") as f:
-            f.write(raw_b64)
-
-        return decode_base64_content(raw_b64)
-    except Exception as e:
-        logger.error(f"Fetch Error: {e}")
-
-    if cache_file.exists():
-        with open(cache_file, "r", encoding="utf-8") as f:
-            return decode_base64_content(f.read())
-    raise RuntimeError("Fetch and cache failed")
+def clash_entry(
+    node: Node,
+    up_pref: str,
+    down_pref: str,
+    node_filter: KeywordMatcher,
+    clean_node_fn,
+    shaping: Shaping = NO_SHAPING,
+) -> Optional[Tuple[bool, dict]]:
+    # (accepted by node_filter, finished proxy); None for unsupported types
+    serialize = CLASH_EMITTERS.get(node.type)
+    if serialize is None:
+        return None
+    # Proxies are born flow-style, so final_format_data passes them through
+    proxy = FinalFlowDict(serialize(node))
+    accepted = node_filter.accepts(proxy["name"])
+    proxy["name"] = clean_node_fn(proxy["name"])
+    process_proxy_config_clash(proxy, up_pref, down_pref)
+    drop_defaults(proxy, shaping.drop_defaults)
+    return accepted, proxy
 
 
 def process_yaml_content_clash(
-    uri_text: str,
+    nodes: List[Node],
     template_path: Path,
     up_pref: str,
     down_pref: str,
-    shared_kw: list,
-    shared_ex_kw: list,
+    node_filter: KeywordMatcher,
     clean_node_fn,
+    state: Optional[BuildState] = None,
+    shaping: Shaping = NO_SHAPING,
 ):
-    # Force parse as URIs
-    input_data = parse_uris_to_proxies(uri_text)
-
-    if not isinstance(input_data, dict) or not input_data.get("proxies"):
-        preview = uri_text[:100].replace("\n", " ") if uri_text else "Empty content"
-        raise ValueError(f"No valid proxies found. Decoded content preview: {preview}")
-
-    with open(template_path, "r", encoding="utf-8") as f:
-        template_data = yaml.safe_load(f)
-    proxies_orig = input_data.get("proxies", [])
-    filtered_names, _ = filter_node_names_clash(proxies_orig, shared_kw, shared_ex_kw)
-
-    final_proxies = []
-    for p in proxies_orig:
-        if isinstance(p, dict) and p.get("name") in filtered_names:
-            p["name"] = clean_node_fn(p["name"])
-            process_proxy_config_clash(p, up_pref, down_pref)
-            final_proxies.append(p)
-
-    if not final_proxies and proxies_orig:
-        for p in proxies_orig:
-            if isinstance(p, dict):
-                p["name"] = clean_node_fn(p.get("name", ""))
-                process_proxy_config_clash(p, up_pref, down_pref)
-        final_proxies = proxies_orig
-
+    if state is None:
+        state = BuildState("")
+    convert = partial(
+        clash_entry,
+        up_pref=up_pref,
+        down_pref=down_pref,
+        node_filter=node_filter,
+        clean_node_fn=clean_node_fn,
+        shaping=shaping,
+    )
+    entries = [e for e in (state.item(n, convert) for n in nodes) if e is not None]
+    if not entries:
+        raise ValueError("No valid proxies found in subscription")
+
+    template = TEMPLATES.get(template_path, mutable=["proxy-groups"])
+    template_data = template.data
+
+    # Nothing accepted: fall back to every proxy
+    final_proxies = [p for accepted, p in entries if accepted] or [
+        p for _, p in entries
+    ]
+    final_proxies = cap_regions(
+        unique_names(final_proxies, "name"),
+        shaping.max_per_region,
+        itemgetter("name"),
+        region_classifier(node_filter.include, clean_node_fn),
+    )
     final_proxies.append({"name": "dns-out", "type": "dns"})
     template_data["proxies"] = final_proxies
 
     if "proxy-groups" in template_data:
         all_node_names = [p["name"] for p in final_proxies]
-        temp_groups = []
-        for group in template_data["proxy-groups"]:
+        members = top_members(
+            state.match(template.compiled, all_node_names), shaping.group_top_n
+        )
+        groups = template_data["proxy-groups"]
+        for group in groups:
             if "filter" in group:
                 existing = group.get("proxies", [])
-                pattern = group.pop("filter")
+                group.pop("filter")
                 group.pop("include-all-proxies", None)
-                try:
-                    matcher = re.compile(pattern, re.IGNORECASE)
-                    matched = [n for n in all_node_names if matcher.search(n)]
+                if group["name"] not in template.compiled.invalid:
+                    seen = set(existing)
                     group["proxies"] = existing + [
-                        n for n in matched if n not in existing
+                        n for n in members.get(group["name"], []) if n not in seen
                     ]
-                except Exception:
-                    pass
-                if group.get("proxies"):
-                    temp_groups.append(group)
-            else:
-                temp_groups.append(group)
 
-        final_groups = []
-        surviving = {g["name"] for g in temp_groups if "name" in g}
-        valid_targets = (
-            set(all_node_names)
-            | surviving
-            | {"DIRECT", "REJECT", "PASS", "REJECT-DROP", "GCP-outbound"}
+        kept = prune_groups(
+            {g["name"]: g.get("proxies", []) for g in groups},
+            set(all_node_names) | CLASH_BUILTIN_TARGETS,
         )
-        for group in temp_groups:
-            refs = [r for r in group.get("proxies", []) if r in valid_targets]
-            if refs:
-                group["proxies"] = refs
+        final_groups = []
+        for group in groups:
+            if group["name"] in kept:
+                group["proxies"] = kept[group["name"]]
                 final_groups.append(group)
         template_data["proxy-groups"] = final_groups
 
-    processed_data = process_data(template_data)
-    return yaml.dump(
-        processed_data,
-        allow_unicode=True,
-        sort_keys=False,
-        default_flow_style=False,
-        width=float("inf"),
-    ).encode("utf-8")
+        if shaping.group_top_n is not None:
+            template_data["proxies"] = drop_ungrouped(
+                final_proxies,
+                "name",
+                [p["name"] for p in final_proxies if p["type"] != "dns"],
+                [g["proxies"] for g in final_groups],
+            )
 
+    return template_data
 
-def inject_custom_clash_node(yaml_bytes: bytes, node_path: Path) -> bytes:
+
+def inject_custom_clash_node(config: dict, node_path: Path) -> dict:
     if not node_path.exists():
-        return yaml_bytes
+        return config
     try:
         with open(node_path, "r", encoding="utf-8") as f:
-            custom_data = yaml.safe_load(f)
+            custom_data = yaml.load(f, Loader=YamlLoader)
         if not custom_data:
-            return yaml_bytes
+            return config
         nodes = custom_data if isinstance(custom_data, list) else [custom_data]
-        config = yaml.safe_load(yaml_bytes)
         for node in nodes:
             if isinstance(node, dict) and "name" in node:
                 config.setdefault("proxies", []).append(node)
-
-        processed_data = process_data(config)
-        return yaml.dump(
-            processed_data,
-            allow_unicode=True,
-            sort_keys=False,
-            default_flow_style=False,
-            width=float("inf"),
-        ).encode("utf-8")
     except Exception as e:
         logger.error(f"[Clash] Inject Error: {e}")
-        return yaml_bytes
+    return config
 
 
 # ================= FINAL FORMATTING =================
@@ -382,11 +223,14 @@ def final_flow_sequence_representer(dumper, data):
     return dumper.represent_sequence("tag:yaml.org,2002:seq", data, flow_style=True)
 
 
-yaml.add_representer(FinalFlowDict, final_flow_mapping_representer)
-yaml.add_representer(FinalFlowList, final_flow_sequence_representer)
+yaml.add_representer(FinalFlowDict, final_flow_mapping_representer, Dumper=YamlDumper)
+yaml.add_representer(FinalFlowList, final_flow_sequence_representer, Dumper=YamlDumper)
 
 
 def final_format_data(data, level=0):
+    if isinstance(data, FinalFlowDict):
+        # Already shaped (emitted proxies); skip the recursive copy
+        return data
     if isinstance(data, dict):
         if level > 0 and all(not isinstance(v, (dict, list)) for v in data.values()):
             return FinalFlowDict(
@@ -400,8 +244,12 @@ def final_format_data(data, level=0):
 
         if all(isinstance(i, dict) for i in data):
             return [
-                FinalFlowDict(
-                    {k: final_format_data(v, level + 1) for k, v in i.items()}
+                (
+                    i
+                    if isinstance(i, FinalFlowDict)
+                    else FinalFlowDict(
+                        {k: final_format_data(v, level + 1) for k, v in i.items()}
+                    )
                 )
                 for i in data
             ]
@@ -417,75 +265,187 @@ def final_format_data(data, level=0):
     return data
 
 
+def _dump_yaml(data) -> bytes:
+    return yaml.dump(
+        data,
+        Dumper=YamlDumper,
+        allow_unicode=True,
+        sort_keys=False,
+        default_flow_style=False,
+        width=YAML_WIDTH,
+    ).encode("utf-8")
+
+
+def _dump_sections(sections: List[dict]) -> List[bytes]:
+    # Top-level "key: value" blocks, as final_format_data(config) shapes them
+    return [
+        _dump_yaml({k: final_format_data(v, 1) for k, v in section.items()})
+        for section in sections
+    ]
+
+
+def _dump_lines(items: List[dict]) -> List[bytes]:
+    # One dump for the batch, split back into its one-line "- {...}" items
+    lines = _dump_yaml(final_format_data(items, 1)).splitlines(keepends=True)
+    if len(lines) == len(items):
+        return lines
+    return [_dump_yaml(final_format_data([i], 1)) for i in items]
+
+
+# Top-level lists dumped (and reused) item by item: one flow-style line each
+LINE_SECTIONS = ("proxies", "proxy-groups")
+
+
+def dump_clash(config: dict, state: Optional[BuildState] = None) -> bytes:
+    # The only serialization on the request path. The document is dumped
+    # in pieces with the same bytes as one yaml.dump(final_format_data());
+    # with a state, pieces unchanged since the last build are reused.
+    if state is None:
+        state = BuildState("")
+    parts = []
+    for key, value in config.items():
+        if (
+            key in LINE_SECTIONS
+            and isinstance(value, list)
+            and value
+            and all(isinstance(i, dict) for i in value)
+        ):
+            parts.append(f"{key}:\n".encode("utf-8"))
+            parts.extend(state.fragments_for(value, _dump_lines))
+        else:
+            parts.extend(state.fragments_for([{key: value}], _dump_sections))
+    return b"".join(parts)
+
+
 # ====================================================
 
 
+CLASH_PROFILES = {
+    # profile -> (template, hysteria2 up, hysteria2 down)
+    "m": ("yaml/m.yaml", "30 Mbps", "60 Mbps"),
+    "mtun": ("yaml/mtun.yaml", "30 Mbps", "60 Mbps"),
+    "pc": ("yaml/pc.yaml", "50 Mbps", "200 Mbps"),
+    "openwrt": ("yaml/openwrt.yaml", "50 Mbps", "200 Mbps"),
+}
+# Phones: fewer nodes to parse and probe, no fields mihomo defaults anyway
+PHONE_SHAPING = Shaping(
+    max_per_region=20, group_top_n=10, drop_defaults=(("network", "tcp"),)
+)
+CLASH_SHAPING = {"m": PHONE_SHAPING, "mtun": PHONE_SHAPING}
+SUBSCRIPTION_USERINFO = (
+    "upload=0; download=715112054784; total=1072668082176; expire=1893456000"
+)
+
+
+def profile_for(ua: str) -> Optional[str]:
+    if "ClashMetaForAndroid" in ua:
+        return "mtun"
+    elif "clash_pc" in ua:
+        return "pc"
+    elif "clash_openwrt" in ua:
+        return "openwrt"
+    elif "clash_m" in ua:
+        return "m"
+    return None
+
+
+def render_config(
+    source,
+    profile,
+    load_nodes,
+    node_filter,
+    clean_fn,
+    custom_node_path,
+    inject_templates,
+    base_dir,
+    render_cache,
+) -> Rendered:
+    template, up, down = CLASH_PROFILES[profile]
+    shaping = CLASH_SHAPING.get(profile, NO_SHAPING)
+    template_path = base_dir / template
+    inject = profile in inject_templates
+    slot = (source, "clash", profile)
+
+    source_hash, nodes = load_nodes()
+    base_key, cache_key = render_cache.make_keys(
+        slot,
+        source_hash,
+        files=[
+            template_path,
+            custom_node_path if inject else None,
+            *CODE_FILES,
+            __file__,
+            source_file(clean_fn),
+        ],
+        extra=[up, down, node_filter.include, node_filter.exclude, shaping],
+    )
+    rendered = render_cache.get(slot, cache_key)
+    if rendered is not None:
+        return rendered
+
+    state = BUILDS.start(slot, base_key)
+    count("build", "incremental" if state.incremental else "full")
+    with stage("build"):
+        config = process_yaml_content_clash(
+            nodes, template_path, up, down, node_filter, clean_fn, state, shaping
+        )
+
+    if inject:
+        with stage("inject"):
+            config = inject_custom_clash_node(config, custom_node_path)
+
+    with stage("dump"):
+        data = dump_clash(config, state)
+    BUILDS.commit(slot, state)
+    return render_cache.put(slot, cache_key, data)
+
+
 def handle_request(
     source,
-    url,
     ua,
     is_force_refresh,
-    cache_dir,
-    cache_expire,
-    shared_kw,
-    shared_ex_kw,
+    rebuild_nodes,
+    load_nodes,
+    node_filter,
     clean_fn,
     custom_node_path,
     target_groups,
     inject_templates,
     base_dir,
+    render_cache,
 ):
-    clash_config_val = None
-    if "ClashMetaForAndroid" in ua:
-        clash_config_val = "mtun"
-    elif "clash_pc" in ua:
-        clash_config_val = "pc"
-    elif "clash_openwrt" in ua:
-        clash_config_val = "openwrt"
-    elif "clash_m" in ua:
-        clash_config_val = "m"
-    else:
+    clash_config_val = profile_for(ua)
+    if not clash_config_val:
         abort(404)
-
-    config_map = {
-        "m": (base_dir / "yaml/m.yaml", "30 Mbps", "60 Mbps"),
-        "mtun": (base_dir / "yaml/mtun.yaml", "30 Mbps", "60 Mbps"),
-        "pc": (base_dir / "yaml/pc.yaml", "50 Mbps", "200 Mbps"),
-        "openwrt": (base_dir / "yaml/openwrt.yaml", "50 Mbps", "200 Mbps"),
-    }
-    template_path, up, down = config_map[clash_config_val]
+    slot = (source, "clash", clash_config_val)
 
     try:
-        uri_text = fetch_uris_text(
-            unquote(url), source, is_force_refresh, cache_dir, cache_expire
-        )
-        output_bytes = process_yaml_content_clash(
-            uri_text, template_path, up, down, shared_kw, shared_ex_kw, clean_fn
-        )
+        published = render_cache.published(slot, "yaml")
+        if published and not (is_force_refresh or rebuild_nodes):
+            response = render_cache.send_published(
+                published, "text/yaml", "config.yaml"
+            )
+        else:
+            rendered = render_cache.render(
+                slot,
+                lambda: render_config(
+                    source,
+                    clash_config_val,
+                    load_nodes,
+                    node_filter,
+                    clean_fn,
+                    custom_node_path,
+                    inject_templates,
+                    base_dir,
+                    render_cache,
+                ),
+                is_force_refresh,
+                rebuild_nodes,
+            )
 
-        if clash_config_val in inject_templates:
-            output_bytes = inject_custom_clash_node(output_bytes, custom_node_path)
-
-        final_config = yaml.safe_load(output_bytes)
-        formatted_config = final_format_data(final_config)
-        output_bytes = yaml.dump(
-            formatted_config,
-            allow_unicode=True,
-            sort_keys=False,
-            default_flow_style=False,
-            width=float("inf"),
-        ).encode("utf-8")
-
-        response = send_file(
-            io.BytesIO(output_bytes),
-            mimetype="text/yaml",
-            as_attachment=True,
-            download_name="config.yaml",
-        )
+            response = render_cache.send(slot, rendered, "text/yaml", "config.yaml")
 
-        response.headers["Subscription-Userinfo"] = (
-            "upload=0; download=715112054784; total=1072668082176; expire=1893456000"
-        )
+        response.headers["Subscription-Userinfo"] = SUBSCRIPTION_USERINFO
 
         return response
     except Exception as e:
@@ -0,0 +1,107 @@
+import logging
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+logger = logging.getLogger(__name__)
+
+_GLOBAL_FLAGS = re.compile(r"^\(\?([aimsux]+)\)")
+_INDEX_LIMIT = 10000
+
+
+def _scoped(pattern: str) -> str:
+    # "(?i)foo" -> "(?i:foo)": global flags are only legal at the very start
+    m = _GLOBAL_FLAGS.match(pattern)
+    if m:
+        return f"(?{m.group(1)}:{pattern[m.end():]})"
+    return f"(?:{pattern})"
+
+
+class GroupFilter:
+    """All proxy-group filter regexes of one template, compiled up front.
+
+    Every combinable filter becomes an optional lookahead in a single
+    regex, so one match() per node name yields all of its groups.
+    Filters with their own capture groups can't be merged (group numbers
+    would shift) and are matched separately.
+    """
+
+    def __init__(self, filters: Iterable[Tuple[str, List[str]]]):
+        self.invalid = set()
+        self._separate: List[Tuple[str, Pattern]] = []
+        self._slots: Dict[str, str] = {}
+        parts = []
+
+        for key, patterns in filters:
+            try:
+                single = re.compile("|".join(_scoped(p) for p in patterns), re.I)
+            except (re.error, TypeError) as e:
+                logger.warning(f"Bad filter for group {key}: {e}")
+                self.invalid.add(key)
+                continue
+            if single.groups:
+                self._separate.append((key, single))
+                continue
+            slot = f"g{len(self._slots)}"
+            self._slots[slot] = key
+            parts.append(f"(?:(?=.*?{single.pattern})(?P<{slot}>))?")
+
+        self._combined: Optional[Pattern] = (
+            re.compile("".join(parts), re.I) if parts else None
+        )
+        self._index: Dict[str, Tuple[str, ...]] = {}
+
+    def groups_of(self, name: str) -> Tuple[str, ...]:
+        hit = self._index.get(name)
+        if hit is not None:
+            return hit
+
+        keys = []
+        if self._combined:
+            m = self._combined.match(name)
+            keys = [self._slots[s] for s, v in m.groupdict().items() if v is not None]
+        keys += [key for key, rx in self._separate if rx.search(name)]
+        hit = tuple(keys)
+
+        # Node names are stable across refreshes; keep the index bounded
+        if len(self._index) >= _INDEX_LIMIT:
+            self._index.clear()
+        self._index[name] = hit
+        return hit
+
+    def match_all(self, names: Iterable[str]) -> Dict[str, List[str]]:
+        # Single pass over the node list; members keep node order
+        result: Dict[str, List[str]] = {}
+        for name in names:
+            for key in self.groups_of(name):
+                result.setdefault(key, []).append(name)
+        return result
+
+    def update_all(
+        self,
+        previous_names: List[str],
+        previous: Dict[str, List[str]],
+        names: List[str],
+    ) -> Dict[str, List[str]]:
+        """match_all(names), given `previous` = match_all(previous_names).
+
+        Only groups that an added or removed name belongs to are rebuilt;
+        the others keep their member lists. Falls back to a full match
+        when the names both lists share were reordered.
+        """
+        delta = Counter(names)
+        delta.subtract(previous_names)
+        changed = {name for name, n in delta.items() if n}
+        if [n for n in previous_names if n not in changed] != [
+            n for n in names if n not in changed
+        ]:
+            return self.match_all(names)
+
+        affected = {key for name in changed for key in self.groups_of(name)}
+        result = {k: v for k, v in previous.items() if k not in affected}
+        if affected:
+            for name in names:
+                for key in self.groups_of(name):
+                    if key in affected:
+                        result.setdefault(key, []).append(name)
+        return result
@@ -0,0 +1,73 @@
+import logging
+from typing import Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+def _break_cycles(groups: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    # Iterative DFS in template order; a reference back to a group still on
+    # the stack closes a cycle and is dropped (clients reject group loops)
+    state: Dict[str, int] = {}  # 1 = on the stack, 2 = done
+    acyclic: Dict[str, List[str]] = {name: [] for name in groups}
+    for root in groups:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(groups[root]))]
+        while stack:
+            name, refs = stack[-1]
+            for ref in refs:
+                if state.get(ref) == 1:
+                    logger.warning(f"Group cycle: dropped {name} -> {ref}")
+                    continue
+                acyclic[name].append(ref)
+                if ref in groups and ref not in state:
+                    state[ref] = 1
+                    stack.append((ref, iter(groups[ref])))
+                    break
+            else:
+                state[name] = 2
+                stack.pop()
+    return acyclic
+
+
+def prune_groups(
+    groups: Dict[str, List[str]], leaves: Set[str]
+) -> Dict[str, List[str]]:
+    """Resolve group references to the groups that can actually be used.
+
+    `groups` maps each group name to the names it references, in order;
+    `leaves` are the other valid targets (nodes, built-in policies). A
+    group is kept if it reaches a leaf through kept groups, so removing
+    one group also removes every group left pointing only at it, however
+    deeply nested. References to unknown or removed names are dropped,
+    and so are references that would close a cycle.
+
+    Returns the kept groups, in input order, with their kept references.
+    Every reference is visited a constant number of times: O(groups + refs).
+    """
+    groups = _break_cycles(groups)
+
+    # Reverse edges: group -> groups that reference it
+    referrers: Dict[str, List[str]] = {}
+    alive: Set[str] = set()
+    for name, refs in groups.items():
+        for ref in refs:
+            if ref in groups:
+                referrers.setdefault(ref, []).append(name)
+            elif ref in leaves:
+                alive.add(name)
+
+    # Least fixed point: spread liveness from leaf-backed groups upwards
+    queue = list(alive)
+    while queue:
+        for referrer in referrers.get(queue.pop(), []):
+            if referrer not in alive:
+                alive.add(referrer)
+                queue.append(referrer)
+
+    return {
+        name: [r for r in refs if r in alive or (r in leaves and r not in groups)]
+        for name, refs in groups.items()
+        if name in alive
+    }
@@ -0,0 +1,48 @@
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+
+# ================= Server =================
+# Production entry: gunicorn -c gunicorn.conf.py app-dev:app
+bind = f"0.0.0.0:{os.getenv('CONVERT_PORT', '5000')}"
+workers = int(os.getenv("CONVERT_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("CONVERT_THREADS", "4"))
+
+# Recycle workers periodically; jitter keeps them from restarting together
+max_requests = int(os.getenv("CONVERT_MAX_REQUESTS", "2000"))
+max_requests_jitter = max_requests // 10
+timeout = 60
+graceful_timeout = 30
+# Longer than cloudflared's idle timeout so pooled connections get reused
+keepalive = int(os.getenv("CONVERT_KEEPALIVE", "75"))
+
+accesslog = None
+errorlog = "-"
+loglevel = "info"
+
+# ================= Template Watch =================
+BASE_DIR = Path(__file__).resolve().parent
+WATCH_GLOBS = ["yaml/*.yaml", "json/*.json", "node.yaml", "node.json"]
+WATCH_INTERVAL = 5
+
+
+def _snapshot():
+    return {p: p.stat().st_mtime_ns for g in WATCH_GLOBS for p in BASE_DIR.glob(g)}
+
+
+def when_ready(server):
+    # Runs in the master: HUP on template change rolls workers gracefully
+    def watch():
+        last = _snapshot()
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current = _snapshot()
+            if current != last:
+                server.log.info("Templates changed, reloading workers")
+                os.kill(os.getpid(), signal.SIGHUP)
+                last = current
+
+    threading.Thread(target=watch, name="template-watch", daemon=True).start()
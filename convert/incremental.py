@@ -0,0 +1,116 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from group_filter import GroupFilter
+from uri_parser import Node
+
+logger = logging.getLogger(__name__)
+
+Slot = Tuple[str, str, str]
+
+
+class BuildState:
+    """What one render of a (source, kind, profile) produced, to patch the next.
+
+    base       key of everything except the nodes (template, profile,
+               filters); a state only reuses a previous one with the same base
+    items      Node.key() -> the converter's entry for that node
+    names      names the group filters were matched against, in order
+    members    group -> matched names, as from GroupFilter.match_all()
+    fragments  serialized document pieces, by repr() of their content
+
+    Each build starts a fresh state and copies over only what it still
+    uses, so a state never grows past the current document. A converter
+    called without a state builds everything into a throwaway
+    BuildState("").
+    """
+
+    def __init__(self, base: str, previous: Optional["BuildState"] = None):
+        self.base = base
+        self._previous = (
+            previous if previous is not None and previous.base == base else None
+        )
+        self.items: Dict[Tuple, Any] = {}
+        self.names: List[str] = []
+        self.members: Dict[str, List[str]] = {}
+        self.fragments: Dict[str, bytes] = {}
+        self.reused = 0
+        self.converted = 0
+
+    @property
+    def incremental(self) -> bool:
+        return self._previous is not None
+
+    def item(self, node: Node, convert: Callable[[Node], Any]) -> Any:
+        key = node.key()
+        if key in self.items:
+            # Duplicate node: its own copy (shared objects dump as YAML aliases)
+            self.converted += 1
+            return convert(node)
+        if self._previous is not None and key in self._previous.items:
+            value = self._previous.items[key]
+            self.reused += 1
+        else:
+            value = convert(node)
+            self.converted += 1
+        self.items[key] = value
+        return value
+
+    def match(
+        self, group_filter: GroupFilter, names: List[str]
+    ) -> Dict[str, List[str]]:
+        # One pass over the names fills every filtered group; after a small
+        # subscription change only the groups it touches are redone
+        if self._previous is None:
+            members = group_filter.match_all(names)
+        else:
+            members = group_filter.update_all(
+                self._previous.names, self._previous.members, names
+            )
+        self.names, self.members = names, members
+        return members
+
+    def fragments_for(
+        self, contents: List[Any], render: Callable[[List[Any]], List[bytes]]
+    ) -> List[bytes]:
+        # Pieces whose content is unchanged are reused; the rest are
+        # serialized together in one `render` call
+        previous = self._previous.fragments if self._previous is not None else {}
+        keys = [repr(c) for c in contents]
+        pieces = [self.fragments.get(k) or previous.get(k) for k in keys]
+        missing = [i for i, piece in enumerate(pieces) if piece is None]
+        if missing:
+            rendered = render([contents[i] for i in missing])
+            for i, piece in zip(missing, rendered):
+                pieces[i] = piece
+        for key, piece in zip(keys, pieces):
+            self.fragments[key] = piece
+        return pieces
+
+
+class BuildStates:
+    """The last BuildState per slot, in memory (rebuilt after a restart)."""
+
+    def __init__(self):
+        self._states: Dict[Slot, BuildState] = {}
+        self._lock = threading.Lock()
+
+    def start(self, slot: Slot, base: str) -> BuildState:
+        with self._lock:
+            return BuildState(base, self._states.get(slot))
+
+    def commit(self, slot: Slot, state: BuildState):
+        if state.incremental:
+            logger.info(
+                f"Incremental build [{'/'.join(slot)}]: reused {state.reused}"
+                f"/{state.reused + state.converted} nodes"
+            )
+        # Drop the link so states don't chain
+        state._previous = None
+        with self._lock:
+            self._states[slot] = state
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
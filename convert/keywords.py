@@ -0,0 +1,46 @@
+import re
+from typing import Iterable, Tuple
+
+
+def _alternation(words: Tuple[str, ...]) -> str:
+    # Longest first so a short keyword never shadows a longer one
+    return "|".join(map(re.escape, sorted(words, key=len, reverse=True)))
+
+
+class KeywordMatcher:
+    """Include/exclude keyword filter for node names, compiled once.
+
+    All keywords go into one case-insensitive alternation wrapped in a
+    lookahead, so a single finditer() scan visits every position of the
+    name once and sees overlapping include and exclude hits alike.
+    """
+
+    def __init__(self, include: Iterable[str], exclude: Iterable[str]):
+        self.include = tuple(k for k in include if isinstance(k, str) and k)
+        self.exclude = tuple(k for k in exclude if isinstance(k, str) and k)
+        parts = []
+        if self.exclude:
+            parts.append(f"(?P<ex>{_alternation(self.exclude)})")
+        if self.include:
+            parts.append(f"(?P<inc>{_alternation(self.include)})")
+        self._scanner = (
+            re.compile(f"(?={'|'.join(parts)})", re.IGNORECASE) if parts else None
+        )
+
+    def classify(self, name: str) -> Tuple[bool, bool]:
+        # -> (has include keyword, has exclude keyword)
+        found_inc = False
+        if not self._scanner or not isinstance(name, str):
+            return found_inc, False
+        for m in self._scanner.finditer(name):
+            if m.lastgroup == "ex":
+                return found_inc, True
+            found_inc = True
+        return found_inc, False
+
+    def excluded(self, name: str) -> bool:
+        return self.classify(name)[1]
+
+    def accepts(self, name: str) -> bool:
+        found_inc, found_ex = self.classify(name)
+        return found_inc and not found_ex
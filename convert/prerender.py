@@ -0,0 +1,80 @@
+import fcntl
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+def _run_all(jobs: Dict[str, Callable[[], Any]], level: int) -> List[str]:
+    failed = []
+    for name, job in jobs.items():
+        try:
+            job()
+        except Exception as e:
+            failed.append(name)
+            logger.log(level, f"Warm-up Error [{name}]: {e}")
+    return failed
+
+
+def warm_up(
+    jobs: Dict[str, Callable[[], Any]], retry_interval: float = 10
+) -> List[str]:
+    """Run every job once, in order; returns the names of those that failed.
+
+    The returned list stays live: a background thread retries the failed
+    jobs every `retry_interval` and empties it once they all succeed, e.g.
+    after the refresher has fetched a subscription that was down at boot.
+    """
+    start = time.perf_counter()
+    failed = _run_all(jobs, logging.ERROR)
+    logger.info(
+        f"Warm-up done: {len(jobs) - len(failed)}/{len(jobs)} configs"
+        f" in {time.perf_counter() - start:.2f}s"
+    )
+
+    def retry():
+        while failed:
+            time.sleep(retry_interval)
+            # Quiet: a source still down fails the same way every round
+            failed[:] = _run_all({n: jobs[n] for n in failed}, logging.DEBUG)
+        logger.info(f"Warm-up recovered: {len(jobs)}/{len(jobs)} configs")
+
+    if failed:
+        threading.Thread(target=retry, name="warm-up", daemon=True).start()
+    return failed
+
+
+def run_once(jobs: Dict[str, Callable[[], bool]]):
+    for name, job in jobs.items():
+        try:
+            if job():
+                logger.info(f"Prerendered {name}")
+        except Exception as e:
+            logger.error(f"Prerender Error [{name}]: {e}")
+
+
+def start_prerender(
+    jobs: Dict[str, Callable[[], bool]], lock_path: Path, interval: float = 30
+):
+    """Keep every published combination current, off the request path.
+
+    Each job renders through the render cache (a key check when nothing
+    changed) and rewrites its files only when the output changed, so a
+    subscription refresh or template edit is published within `interval`.
+    Workers sharing the cache take turns: one pass runs at a time.
+    """
+
+    def loop():
+        while True:
+            try:
+                with open(lock_path, "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    run_once(jobs)
+            except BlockingIOError:
+                pass
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="prerender", daemon=True).start()
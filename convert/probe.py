@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import logging
+import socket
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from timing import stage
+from uri_parser import Node
+
+logger = logging.getLogger(__name__)
+
+Endpoint = Tuple[str, int]
+
+# hysteria2 is QUIC over UDP: a TCP connect says nothing about it
+UNPROBED_TYPES = {"hysteria2"}
+# Latencies within one bucket count as equal, so jitter doesn't reshuffle
+# the output (and its ETag) on every probe round
+LATENCY_BUCKET = 0.02
+
+
+class LatencyProber:
+    """TCP connect latency to node endpoints, measured server-side.
+
+    Endpoints are probed concurrently (at most `concurrency` at once) and
+    results are reused for `ttl` seconds. Failed connects are cached as
+    None, i.e. dead.
+    """
+
+    def __init__(self, ttl: float = 300, timeout: float = 1.5, concurrency: int = 64):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._results: Dict[Endpoint, Tuple[float, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    async def _probe_one(
+        self, endpoint: Endpoint, sem: asyncio.Semaphore
+    ) -> Optional[float]:
+        async with sem:
+            start = time.perf_counter()
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*endpoint), self.timeout
+                )
+            except (OSError, asyncio.TimeoutError):
+                return None
+            latency = time.perf_counter() - start
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return latency
+
+    async def _probe_all(self, endpoints: List[Endpoint]) -> List[Optional[float]]:
+        sem = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*(self._probe_one(e, sem) for e in endpoints))
+
+    def measure(self, endpoints: Iterable[Endpoint]) -> Dict[Endpoint, Optional[float]]:
+        """Latency in seconds per endpoint (None = unreachable)."""
+        endpoints = set(endpoints)
+        # One probe round at a time; later callers reuse its results
+        with self._lock:
+            now = time.time()
+            stale = [
+                e
+                for e in endpoints
+                if e not in self._results or now - self._results[e][0] >= self.ttl
+            ]
+            if stale:
+                latencies = asyncio.run(self._probe_all(stale))
+                now = time.time()
+                for endpoint, latency in zip(stale, latencies):
+                    self._results[endpoint] = (now, latency)
+                alive = sum(latency is not None for latency in latencies)
+                logger.info(f"Probed {len(stale)} endpoints: {alive} reachable")
+            return {e: self._results[e][1] for e in endpoints}
+
+    def rank(self, nodes: List[Node], prune: bool = True) -> List[Node]:
+        """Nodes ordered fastest first; unprobed types follow in input order.
+
+        With `prune`, unreachable nodes are dropped, unless that would
+        drop every node (e.g. this host has no outbound route at all).
+        """
+        probed = [n for n in nodes if n.type not in UNPROBED_TYPES]
+        latencies = self.measure((n.server, n.port) for n in probed)
+
+        ranked = []
+        for index, node in enumerate(nodes):
+            if node.type in UNPROBED_TYPES:
+                ranked.append(((1, index), node))
+                continue
+            latency = latencies[(node.server, node.port)]
+            if latency is None:
+                if not prune:
+                    ranked.append(((2, index), node))
+                continue
+            ranked.append(((0, int(latency / LATENCY_BUCKET), index), node))
+
+        if not any(key[0] == 0 for key, _ in ranked):
+            return nodes
+        ranked.sort(key=lambda item: item[0])
+        return [node for _, node in ranked]
+
+    def ranked(
+        self, source_hash: str, nodes: List[Node], prune: bool = True
+    ) -> Tuple[str, List[Node]]:
+        # Fold the resulting order into the hash so render caches follow it
+        with stage("probe"):
+            result = self.rank(nodes, prune)
+        digest = hashlib.sha256(source_hash.encode("utf-8"))
+        for node in result:
+            digest.update(f"{node.server}:{node.port}:{node.name}\0".encode("utf-8"))
+        return digest.hexdigest(), result
+
+
+# ================= Self-check =================
+def self_check() -> bool:
+    """Rank local stand-ins: a listener, a closed port and a hysteria2 node."""
+    with socket.socket() as listener, socket.socket() as closed:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        closed.bind(("127.0.0.1", 0))
+        live_port = listener.getsockname()[1]
+        # Bound but not listening: connects are refused
+        dead_port = closed.getsockname()[1]
+
+        def node(name: str, type_: str, port: int) -> Node:
+            return Node(type=type_, name=name, server="127.0.0.1", port=port)
+
+        dead = node("dead", "trojan", dead_port)
+        hy = node("hy", "hysteria2", dead_port)
+        live = node("live", "vless", live_port)
+        cases = [
+            # Fastest first, unprobed types after, unreachable dropped
+            ("prune", [dead, hy, live], True, ["live", "hy"]),
+            ("keep", [dead, hy, live], False, ["live", "hy", "dead"]),
+            # Nothing reachable: the input is kept as is
+            ("all dead", [dead, hy], True, ["dead", "hy"]),
+        ]
+        ok = True
+        for label, nodes, prune, expected in cases:
+            got = [n.name for n in LatencyProber(timeout=1).rank(nodes, prune)]
+            ok &= got == expected
+            print(f"{label:9} {'ok' if got == expected else 'FAIL'}  {got}")
+        return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if self_check() else 1)
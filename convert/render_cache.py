@@ -0,0 +1,352 @@
+import gzip
+import hashlib
+import inspect
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from flask import Response, request, send_file
+
+import group_filter
+import group_graph
+import incremental
+import keywords
+import shaping
+from singleflight import SingleFlight
+import templates
+from timing import count, stage
+import uri_parser
+
+logger = logging.getLogger(__name__)
+
+
+def file_mtime(path: Optional[Path]) -> int:
+    # Missing files hash as 0 so that creating them later invalidates the key
+    if path is None:
+        return 0
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def source_file(obj) -> Optional[Path]:
+    # File defining a module/class/function, so key inputs can cover code;
+    # None for builtins
+    try:
+        path = inspect.getsourcefile(obj)
+    except TypeError:
+        return None
+    return Path(path) if path else None
+
+
+# Shared modules whose code shapes every rendered config: part of each
+# converter's render key, next to its own file and the app's name cleaner
+CODE_FILES = [
+    source_file(module)
+    for module in (
+        group_filter,
+        group_graph,
+        incremental,
+        keywords,
+        shaping,
+        templates,
+        uri_parser,
+    )
+]
+
+
+def write_atomic(path: Path, data: bytes):
+    # Write to a temp file in the same dir, then rename over the target
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        # mkstemp creates 0600; keep the usual file mode
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+# ================= Content-Coding =================
+def _gzip(data: bytes) -> bytes:
+    # mtime=0 keeps gzip output deterministic
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+# Content-Coding -> compressor, preferred first on q-value ties. gzip only:
+# the image installs the locked dependencies (uv sync --frozen), which
+# carry no brotli or zstd binding
+ENCODERS: Dict[str, Callable[[bytes], bytes]] = {"gzip": _gzip}
+
+# File suffix per Content-Coding (nginx gzip_static naming)
+VARIANT_SUFFIX = {"gzip": ".gz"}
+
+
+def compress_variants(data: bytes) -> Dict[str, bytes]:
+    return {coding: encode(data) for coding, encode in ENCODERS.items()}
+
+
+def negotiate(available: List[str]) -> Optional[str]:
+    # Highest client q-value wins; None means send identity
+    return request.accept_encodings.best_match(available)
+
+
+def _encoded_response(response: Response, coding: Optional[str]) -> Response:
+    if coding is not None:
+        response.headers["Content-Encoding"] = coding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+class Rendered(NamedTuple):
+    data: bytes
+    etag: str
+    last_modified: float
+
+
+def make_rendered(data: bytes, last_modified: Optional[float] = None) -> Rendered:
+    # Strong validator derived from the exact bytes sent
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    return Rendered(data, etag, int(last_modified or time.time()))
+
+
+class RenderCache:
+    """Final rendered config bytes, kept in memory and mirrored on disk.
+
+    One slot per (source, kind, profile); the slot is valid while its key
+    matches the key computed for the current request. `flight` lets
+    concurrent identical requests share one fetch and render.
+
+    With a `publish_dir`, renders can also be published there as plain
+    files ({source}/{kind}-{profile}.{ext} plus .gz variants) that are
+    served straight from disk.
+    """
+
+    def __init__(self, cache_dir: Path, publish_dir: Optional[Path] = None):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.publish_dir = publish_dir
+        self._published: Dict[Path, str] = {}
+        self._mem: Dict[Tuple[str, str, str], Tuple[str, Rendered]] = {}
+        self._variants: Dict[Tuple[str, ...], Tuple[str, bytes]] = {}
+        self._lock = threading.Lock()
+        self.flight = SingleFlight()
+
+    @staticmethod
+    def make_key(
+        source: str,
+        profile: str,
+        content: str,
+        files: Iterable[Optional[Path]] = (),
+        extra: Iterable = (),
+    ) -> str:
+        h = hashlib.sha256()
+        h.update(f"{source}\0{profile}\0".encode("utf-8"))
+        h.update(hashlib.sha256(content.encode("utf-8")).digest())
+        for path in files:
+            h.update(f"{path}:{file_mtime(path)}\0".encode("utf-8"))
+        h.update(repr(list(extra)).encode("utf-8"))
+        return h.hexdigest()
+
+    def make_keys(
+        self,
+        slot: Tuple[str, str, str],
+        content_hash: str,
+        files: Iterable[Optional[Path]] = (),
+        extra: Iterable = (),
+    ) -> Tuple[str, str]:
+        """(base key, cache key) for rendering `slot` from `content_hash`.
+
+        The base key covers everything but the nodes (template, code,
+        options): a build state is reusable while it matches. The cache
+        key adds the nodes' hash and names one exact render.
+        """
+        source, _, profile = slot
+        base_key = self.make_key(source, profile, "", files=files, extra=extra)
+        cache_key = self.make_key(source, profile, content_hash, extra=[base_key])
+        return base_key, cache_key
+
+    def _path(self, slot: Tuple[str, str, str]) -> Path:
+        return self.cache_dir / ("_".join(slot) + ".bin")
+
+    def get(self, slot: Tuple[str, str, str], key: str) -> Optional[Rendered]:
+        entry = self._get(slot, key)
+        count("render", "miss" if entry is None else "hit")
+        return entry
+
+    def _get(self, slot: Tuple[str, str, str], key: str) -> Optional[Rendered]:
+        with self._lock:
+            hit = self._mem.get(slot)
+        if hit and hit[0] == key:
+            return hit[1]
+
+        # On-disk layout: "<key>\n<rendered bytes>"
+        path = self._path(slot)
+        try:
+            raw = path.read_bytes()
+            mtime = path.stat().st_mtime
+        except OSError:
+            return None
+        stored_key, _, data = raw.partition(b"\n")
+        if stored_key.decode("ascii", errors="ignore") != key:
+            return None
+        entry = make_rendered(data, mtime)
+        with self._lock:
+            self._mem[slot] = (key, entry)
+        return entry
+
+    def put(self, slot: Tuple[str, str, str], key: str, data: bytes) -> Rendered:
+        entry = make_rendered(data)
+        with self._lock:
+            self._mem[slot] = (key, entry)
+        try:
+            write_atomic(self._path(slot), key.encode("ascii") + b"\n" + data)
+        except OSError as e:
+            logger.warning(f"Render cache write failed for {slot}: {e}")
+        return entry
+
+    def render(
+        self,
+        slot: Tuple[str, str, str],
+        render: Callable[[], Rendered],
+        force_refresh: bool = False,
+        rebuild: bool = False,
+    ) -> Rendered:
+        # Concurrent identical requests share one fetch and render
+        return self.flight.do(slot + (force_refresh, rebuild), render)
+
+    def prerender(
+        self, slot: Tuple[str, str, str], ext: str, render: Callable[[], Rendered]
+    ) -> bool:
+        # Same flight as a plain request, so one arriving mid-render shares it
+        return self.publish(slot, ext, self.render(slot, render))
+
+    # ================= Compressed Variants =================
+    def encoded(
+        self, slot: Tuple[str, str, str], rendered: Rendered, coding: str
+    ) -> bytes:
+        """`rendered` compressed with `coding`, computed once per render."""
+        with self._lock:
+            hit = self._variants.get(slot + (coding,))
+        if hit and hit[0] == rendered.etag:
+            return hit[1]
+        return self.flight.do(
+            ("encode",) + slot + (coding, rendered.etag),
+            lambda: self._load_encoded(slot, rendered, coding),
+        )
+
+    def _load_encoded(
+        self, slot: Tuple[str, str, str], rendered: Rendered, coding: str
+    ) -> bytes:
+        # Stored beside the render entry as "<etag>\n<compressed bytes>"
+        path = self._path(slot)
+        path = path.with_name(path.name + VARIANT_SUFFIX[coding])
+        try:
+            stored_etag, _, body = path.read_bytes().partition(b"\n")
+        except OSError:
+            stored_etag, body = b"", b""
+        if stored_etag.decode("ascii", errors="ignore") == rendered.etag:
+            count("encode", "hit")
+        else:
+            count("encode", "miss")
+            with stage("compress"):
+                body = ENCODERS[coding](rendered.data)
+            try:
+                write_atomic(path, rendered.etag.encode("ascii") + b"\n" + body)
+            except OSError as e:
+                logger.warning(f"Render cache write failed for {slot}: {e}")
+        with self._lock:
+            self._variants[slot + (coding,)] = (rendered.etag, body)
+        return body
+
+    def send(
+        self,
+        slot: Tuple[str, str, str],
+        rendered: Rendered,
+        mimetype: str,
+        download_name: str,
+    ) -> Response:
+        """`rendered` as a download, in the coding the client prefers.
+
+        Each coding is compressed once per render (see encoded()).
+        """
+        coding = negotiate(list(ENCODERS))
+        body, etag = rendered.data, rendered.etag
+        if coding is not None:
+            body = self.encoded(slot, rendered, coding)
+            # Each representation needs its own strong validator
+            etag = f"{etag}-{coding}"
+        # Answers If-None-Match / If-Modified-Since with 304
+        response = send_file(
+            io.BytesIO(body),
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            etag=etag,
+            last_modified=rendered.last_modified,
+            conditional=True,
+        )
+        return _encoded_response(response, coding)
+
+    # ================= Published Files =================
+    def published_path(self, slot: Tuple[str, str, str], ext: str) -> Path:
+        source, kind, profile = slot
+        return self.publish_dir / source / f"{kind}-{profile}.{ext}"
+
+    def published(self, slot: Tuple[str, str, str], ext: str) -> Optional[Path]:
+        if self.publish_dir is None:
+            return None
+        path = self.published_path(slot, ext)
+        return path if path.exists() else None
+
+    @staticmethod
+    def send_published(path: Path, mimetype: str, download_name: str) -> Response:
+        # Pick among the variants written next to the file by publish()
+        coding = negotiate(
+            [
+                coding
+                for coding in ENCODERS
+                if path.with_name(path.name + VARIANT_SUFFIX[coding]).exists()
+            ]
+        )
+        if coding is not None:
+            path = path.with_name(path.name + VARIANT_SUFFIX[coding])
+        # A plain file serve (sendfile under gunicorn); 304s come from its stat
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+        )
+        return _encoded_response(response, coding)
+
+    def publish(self, slot: Tuple[str, str, str], ext: str, rendered: Rendered) -> bool:
+        """Write `rendered` and its compressed variants if it changed."""
+        path = self.published_path(slot, ext)
+        if self._published.get(path) is None:
+            try:
+                self._published[path] = make_rendered(path.read_bytes()).etag
+            except OSError:
+                pass
+        if self._published.get(path) == rendered.etag:
+            return False
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Variants first: the plain file appearing is what marks it current
+        for coding, body in compress_variants(rendered.data).items():
+            write_atomic(path.with_name(path.name + VARIANT_SUFFIX[coding]), body)
+        write_atomic(path, rendered.data)
+        self._published[path] = rendered.etag
+        return True
@@ -0,0 +1,119 @@
+import re
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+def _keyword(word: str) -> str:
+    # Latin keywords must stand alone ("US" is not in "Australia"); CJK
+    # keywords match anywhere
+    if word.isascii():
+        return rf"(?<![A-Za-z]){re.escape(word)}(?![A-Za-z])"
+    return re.escape(word)
+
+
+class Shaping(NamedTuple):
+    """Per-profile trimming, for clients that don't need the full list.
+
+    max_per_region  nodes kept per region, among those the node filter
+                    accepts (unmatched names share one bucket)
+    group_top_n     filter-matched nodes kept per group; nodes left in no
+                    group are not shipped
+    drop_defaults   (field, value) pairs: an entry field holding the
+                    client's own default is left out
+
+    "First" is the node order: the provider's, or fastest first when the
+    nodes were ranked by latency.
+    """
+
+    max_per_region: Optional[int] = None
+    group_top_n: Optional[int] = None
+    drop_defaults: Tuple[Tuple[str, Any], ...] = ()
+
+
+NO_SHAPING = Shaping()
+
+
+@lru_cache(maxsize=8)
+def region_classifier(
+    keywords: Tuple[str, ...], canonical: Callable[[str], str]
+) -> Callable[[str], str]:
+    """Node name -> region, for the app's own region keywords.
+
+    `keywords` are the node filter's include keywords; each is a region,
+    named by what the app's name cleaner (`canonical`) turns it into, so
+    "香港" and "HK" are one region and a keyword added to the app config
+    is a region of its own. Names matching none share the region "".
+    """
+    words = sorted((k for k in keywords if k), key=len, reverse=True)
+    if not words:
+        return lambda name: ""
+    regions = [canonical(k) or k for k in words]
+    rx = re.compile(
+        "|".join(f"(?P<r{i}>{_keyword(k)})" for i, k in enumerate(words)),
+        re.IGNORECASE,
+    )
+
+    @lru_cache(maxsize=16384)
+    def region_of(name: str) -> str:
+        m = rx.search(name)
+        return regions[int(m.lastgroup[1:])] if m else ""
+
+    return region_of
+
+
+def cap_regions(
+    entries: List[T],
+    limit: Optional[int],
+    name: Callable[[T], str],
+    region_of: Callable[[str], str],
+) -> List[T]:
+    # Cap only entries that survived filtering: excluded ones take no slot
+    if limit is None:
+        return entries
+    kept, seen = [], {}
+    for entry in entries:
+        region = region_of(name(entry))
+        if seen.get(region, 0) < limit:
+            seen[region] = seen.get(region, 0) + 1
+            kept.append(entry)
+    return kept
+
+
+def top_members(
+    members: Dict[str, List[str]], limit: Optional[int]
+) -> Dict[str, List[str]]:
+    # New lists: `members` may be shared with the build state
+    if limit is None:
+        return members
+    return {group: names[:limit] for group, names in members.items()}
+
+
+def drop_defaults(entry: dict, defaults: Tuple[Tuple[str, Any], ...]) -> dict:
+    for field, value in defaults:
+        if field in entry and entry[field] == value:
+            del entry[field]
+    return entry
+
+
+def drop_ungrouped(
+    entries: List[dict],
+    field: str,
+    nodes: Iterable[str],
+    groups: Iterable[Iterable[str]],
+) -> List[dict]:
+    # After a top-N cut, nodes no group references would only be dead payload
+    used = {ref for refs in groups for ref in refs}
+    unused = set(nodes) - used
+    return [e for e in entries if e.get(field) not in unused]
@@ -1,14 +1,35 @@
-import base64
 import json
 import logging
-import os
-import re
-import time
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
-from typing import Any, Dict, Union
-from urllib.parse import urlparse, parse_qs, unquote
-import requests
-from flask import Response, jsonify
+from typing import List, Optional
+from flask import jsonify
+
+try:
+    # Optional faster JSON backend; output matches the compact json.dumps
+    import orjson
+except ImportError:
+    orjson = None
+
+from group_filter import GroupFilter
+from group_graph import prune_groups
+from incremental import BuildState, BuildStates
+from keywords import KeywordMatcher
+from render_cache import CODE_FILES, Rendered, source_file
+from shaping import (
+    NO_SHAPING,
+    Shaping,
+    cap_regions,
+    drop_defaults,
+    drop_ungrouped,
+    region_classifier,
+    top_members,
+)
+from templates import TemplateRegistry
+from timing import count, stage
+from upstream import SubscriptionStore
+from uri_parser import SINGBOX_EMITTERS, Node, unique_names
 
 logger = logging.getLogger(__name__)
 
@@ -18,252 +39,111 @@ SB_TEMPLATE_MAP = {
     "mtun": "json/mtun.json",
     "m": "json/m.json",
 }
+# Phones: fewer nodes to parse and probe, no fields sing-box defaults anyway
+PHONE_SHAPING = Shaping(
+    max_per_region=20, group_top_n=10, drop_defaults=(("alter_id", 0),)
+)
+SINGBOX_SHAPING = {"m": PHONE_SHAPING, "mtun": PHONE_SHAPING}
+
+
+def load_singbox_template(path: Path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"Template is not an object: {path}")
+    outbounds = data.get("outbounds", [])
+    if not isinstance(outbounds, list) or not all(
+        isinstance(o, dict) for o in outbounds
+    ):
+        raise ValueError(f"Invalid outbounds in template: {path}")
+    return data
+
+
+def filter_regexes(outbound: dict) -> list:
+    return [
+        reg
+        for f in outbound.get("filter", [])
+        if isinstance(f, dict)
+        for reg in f.get("regex", [])
+    ]
 
 
-def safe_b64decode(s: str) -> str:
-    # Compatible with urlsafe and standard base64 decoding
-    s = s.strip()
-    s += "=" * ((4 - len(s) % 4) % 4)
-    try:
-        return base64.urlsafe_b64decode(s).decode("utf-8")
-    except Exception:
-        return base64.b64decode(s).decode("utf-8")
-
-
-# ================= URI Parsers =================
-def parse_ss(uri: str) -> dict:
-    uri, name = uri.split("#", 1) if "#" in uri else (uri, "SS Node")
-    name = unquote(name)
-    uri = uri[5:]  # Strip ss://
-
-    if "@" in uri:
-        user_part, host_part = uri.split("@", 1)
-        user_info = safe_b64decode(user_part)
-        method, pwd = user_info.split(":", 1)
-        host, port = host_part.split(":", 1)
-    else:
-        decoded = safe_b64decode(uri)
-        user_info, host_part = decoded.split("@", 1)
-        method, pwd = user_info.split(":", 1)
-        host, port = host_part.split(":", 1)
-
-    return {
-        "type": "shadowsocks",
-        "tag": name,
-        "server": host,
-        "server_port": int(port),
-        "method": method,
-        "password": pwd,
-    }
-
-
-def parse_vless(uri: str) -> dict:
-    parsed = urlparse(uri)
-    name = unquote(parsed.fragment) if parsed.fragment else "VLESS Node"
-    qs = parse_qs(parsed.query)
-    node = {
-        "type": "vless",
-        "tag": name,
-        "server": parsed.hostname,
-        "server_port": parsed.port or 443,
-        "uuid": parsed.username,
-    }
-
-    if "flow" in qs and qs["flow"][0]:
-        node["flow"] = qs["flow"][0]
-
-    security = qs.get("security", ["none"])[0]
-    if security in ["tls", "reality"]:
-        tls = {
-            "enabled": True,
-            "server_name": qs.get("sni", [""])[0],
-            "utls": {"enabled": True, "fingerprint": "firefox"},
-        }
-        if security == "reality":
-            tls["reality"] = {
-                "enabled": True,
-                "public_key": qs.get("pbk", [""])[0],
-                "short_id": qs.get("sid", [""])[0],
-            }
-        node["tls"] = tls
-    net = qs.get("type", ["tcp"])[0]
-    if net == "ws":
-        node["transport"] = {"type": "ws", "path": qs.get("path", ["/"])[0]}
-        if "host" in qs:
-            node["transport"]["headers"] = {"Host": qs["host"][0]}
-    elif net == "grpc":
-        node["transport"] = {
-            "type": "grpc",
-            "service_name": qs.get("serviceName", [""])[0],
-        }
-
-    return node
-
-
-def parse_hy2(uri: str) -> dict:
-    parsed = urlparse(uri)
-    name = unquote(parsed.fragment) if parsed.fragment else "HY2 Node"
-    qs = parse_qs(parsed.query)
-
-    # Bypass urlparse error handling for ports containing "-"
-    netloc = parsed.netloc
-    host_port = netloc.split("@")[-1]
-    server_port = None
-    server_ports = None
-
-    if ":" in host_port:
-        host, port_str = host_port.split(":", 1)
-        if "-" in port_str:
-            server_ports = port_str.replace("-", ":")
-        else:
-            server_port = int(port_str)
-    else:
-        server_port = 443
-
-    obfs = None
-    if "obfs" in qs:
-        obfs = {
-            "type": qs["obfs"][0],
-            "password": qs.get("obfs-password", [""])[0],
-        }
-
-    # Construct the dictionary in the exact requested order
-    node = {
-        "type": "hysteria2",
-        "tag": name,
-        "server": parsed.hostname,
-    }
-
-    if server_ports is not None:
-        node["server_ports"] = server_ports
-    else:
-        node["server_port"] = server_port
-
-    node["up_mbps"] = 50
-    node["down_mbps"] = 200
-
-    if obfs:
-        node["obfs"] = obfs
+def compile_singbox_filters(data: dict) -> GroupFilter:
+    return GroupFilter(
+        (o.get("tag"), regex_list)
+        for o in data.get("outbounds", [])
+        if o.get("type") in ["urltest", "selector"]
+        and (regex_list := filter_regexes(o))
+    )
 
-    node["password"] = parsed.username
-    node["tls"] = {"enabled": True, "server_name": qs.get("sni", [""])[0]}
 
-    return node
-
-
-def uri_to_singbox(uri: str) -> Union[Dict[str, Any], None]:
-    try:
-        if uri.startswith("ss://"):
-            return parse_ss(uri)
-        elif uri.startswith("vless://"):
-            return parse_vless(uri)
-        elif uri.startswith("hysteria2://") or uri.startswith("hy2://"):
-            return parse_hy2(uri)
-    except Exception as e:
-        logger.warning(f"Failed to parse URI: {e}")
-    return None
+TEMPLATES = TemplateRegistry(load_singbox_template, compile_singbox_filters)
+# Last build per (source, "singbox", profile), for incremental rebuilds
+BUILDS = BuildStates()
 
 
 # ================= Main Processor =================
-def fetch_and_process_singbox(
-    source: str,
+def singbox_entry(
+    node: Node,
+    node_filter: KeywordMatcher,
+    clean_node_fn,
+    shaping: Shaping = NO_SHAPING,
+) -> Optional[dict]:
+    # Drop excluded nodes before serializing them
+    serialize = SINGBOX_EMITTERS.get(node.type)
+    if not serialize or node_filter.excluded(node.name):
+        return None
+    outbound = serialize(node)
+    outbound["tag"] = clean_node_fn(node.name)
+    return drop_defaults(outbound, shaping.drop_defaults)
+
+
+def process_singbox(
+    parsed: List[Node],
     config_param: str,
-    force_refresh: bool,
-    url: str,
-    cache_dir: Path,
-    cache_expire: int,
-    shared_kw: list,
-    shared_ex_kw: list,
+    node_filter: KeywordMatcher,
     clean_node_fn,
-):
-    # Use .txt suffix for URI list cache
-    cache_file = cache_dir / f"{source}_uris.txt"
-    used_cache = False
-
-    if not force_refresh and cache_file.exists():
-        try:
-            if time.time() - os.path.getmtime(cache_file) < cache_expire:
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    # Read base64 content and decode
-                    raw_b64 = f.read()
-                    decoded_text = safe_b64decode(raw_b64)
-                used_cache = True
-        except Exception:
-            pass
-
-    if not used_cache:
-        try:
-            # Use real browser UA to fetch base64 subscription
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0"
-            }
-            res = requests.get(url, headers=headers, timeout=10)
-            res.raise_for_status()
-
-            raw_b64 = res.text.strip()
-            decoded_text = safe_b64decode(raw_b64)
-
-            if not any(
-                proto in decoded_text
-                for proto in ["ss://", "vless://", "hysteria2://", "hy2://"]
-            ):
-                raise ValueError("No valid protocol URIs found in decoded text")
-
-            # Save raw base64 content to cache
-            with open(cache_file, "w", encoding="utf-8") as f:
-                f.write(raw_b64)
-        except Exception:
-            if cache_file.exists():
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    # Fallback to cache and decode
-                    decoded_text = safe_b64decode(f.read())
-            else:
-                raise RuntimeError("Fetch Error")
-
-    # Parse and assemble nodes
-    lines = [line.strip() for line in decoded_text.splitlines() if line.strip()]
-    nodes = []
-
-    for uri in lines:
-        try:
-            node = uri_to_singbox(uri)
-            if not node:
-                continue
-
-            original_name = node["tag"]
-            if any(ex in original_name for ex in shared_ex_kw):
-                continue
-            node["tag"] = clean_node_fn(original_name)
-            nodes.append(node)
-        except Exception:
-            pass
+    state: Optional[BuildState] = None,
+    shaping: Shaping = NO_SHAPING,
+) -> dict:
+    if state is None:
+        state = BuildState("")
+    convert = partial(
+        singbox_entry,
+        node_filter=node_filter,
+        clean_node_fn=clean_node_fn,
+        shaping=shaping,
+    )
+    nodes = unique_names(
+        [o for o in (state.item(n, convert) for n in parsed) if o is not None], "tag"
+    )
 
     if not nodes:
         raise ValueError("No nodes converted")
+    if shaping.max_per_region is not None:
+        # Only nodes that make it into the config take a region slot
+        nodes = cap_regions(
+            [n for n in nodes if node_filter.accepts(n["tag"])],
+            shaping.max_per_region,
+            itemgetter("tag"),
+            region_classifier(node_filter.include, clean_node_fn),
+        )
 
-    with open(
-        SB_TEMPLATE_MAP.get(config_param, SB_TEMPLATE_MAP["openwrt"]),
-        "r",
-        encoding="utf-8",
-    ) as f:
-        base_config = json.load(f)
+    template = TEMPLATES.get(
+        Path(SB_TEMPLATE_MAP.get(config_param, SB_TEMPLATE_MAP["openwrt"])),
+        mutable=["outbounds"],
+    )
+    base_config = template.data
 
     outbounds = base_config.get("outbounds", [])
     existing_tags = {o.get("tag") for o in outbounds}
-    outbounds.extend(
-        [n for n in nodes if n.get("tag") and n.get("tag") not in existing_tags]
-    )
-
-    def valid_tag(tag: str) -> bool:
-        tu = tag.upper() if tag else ""
-        return any(kw.upper() in tu for kw in shared_kw) and not any(
-            ex.upper() in tu for ex in shared_ex_kw
-        )
+    added = [n for n in nodes if n.get("tag") and n.get("tag") not in existing_tags]
+    outbounds.extend(added)
 
     filtered = [
         o
         for o in outbounds
-        if valid_tag(o.get("tag", ""))
+        if node_filter.accepts(o.get("tag", ""))
         or o.get("type") in ["urltest", "selector", "direct", "block", "dns"]
     ]
     temp_outbounds = []
@@ -273,14 +153,14 @@ def fetch_and_process_singbox(
         if o.get("type") not in ["urltest", "selector", "direct", "block", "dns"]
     ]
 
+    members = top_members(
+        state.match(template.compiled, [t for t in all_tags if t]), shaping.group_top_n
+    )
+
     for outbound in filtered:
         if outbound.get("type") in ["urltest", "selector"] and "filter" in outbound:
-            regex_list = [
-                reg
-                for f in outbound.pop("filter", [])
-                if isinstance(f, dict)
-                for reg in f.get("regex", [])
-            ]
+            regex_list = filter_regexes(outbound)
+            outbound.pop("filter")
             orig_out = outbound.get("outbounds", [])
             if "{all}" in orig_out:
                 orig_out.remove("{all}")
@@ -291,28 +171,28 @@ def fetch_and_process_singbox(
                     temp_outbounds.append(outbound)
                 continue
 
-            try:
-                compiled = re.compile("|".join(regex_list), re.IGNORECASE)
-                matched = [t for t in all_tags if compiled.search(t)]
-                merged = list(dict.fromkeys(orig_out + matched))
-                if merged:
-                    outbound["outbounds"] = merged
-                    temp_outbounds.append(outbound)
-            except Exception:
-                if orig_out:
-                    outbound["outbounds"] = list(dict.fromkeys(orig_out))
-                    temp_outbounds.append(outbound)
+            matched = members.get(outbound.get("tag"), [])
+            merged = list(dict.fromkeys(orig_out + matched))
+            if merged:
+                outbound["outbounds"] = merged
+                temp_outbounds.append(outbound)
         else:
             temp_outbounds.append(outbound)
 
+    groups = {
+        o.get("tag"): o["outbounds"]
+        for o in temp_outbounds
+        if isinstance(o.get("outbounds"), list)
+    }
+    kept = prune_groups(
+        groups, {o.get("tag") for o in temp_outbounds if o.get("tag") not in groups}
+    )
     final_outbounds = []
-    surviving = {o.get("tag") for o in temp_outbounds if o.get("tag")}
     for outbound in temp_outbounds:
-        if "outbounds" in outbound and isinstance(outbound["outbounds"], list):
-            cleaned = [t for t in outbound["outbounds"] if t in surviving]
-            outbound["outbounds"] = cleaned
-            if not cleaned:
+        if isinstance(outbound.get("outbounds"), list):
+            if outbound.get("tag") not in kept:
                 continue
+            outbound["outbounds"] = kept[outbound.get("tag")]
         final_outbounds.append(outbound)
 
     for outbound in final_outbounds:
@@ -321,84 +201,175 @@ def fetch_and_process_singbox(
             if outs and outbound.get("default", "") not in outs:
                 outbound["default"] = outs[0]
 
+    if shaping.group_top_n is not None:
+        final_outbounds = drop_ungrouped(
+            final_outbounds,
+            "tag",
+            [n["tag"] for n in added],
+            [o.get("outbounds", []) for o in final_outbounds],
+        )
+
     base_config["outbounds"] = final_outbounds
-    return json.dumps(base_config, ensure_ascii=False, separators=(",", ":"))
+    return base_config
+
+
+def fetch_and_process_singbox(
+    source: str,
+    config_param: str,
+    force_refresh: bool,
+    url: str,
+    store: SubscriptionStore,
+    node_filter: KeywordMatcher,
+    clean_node_fn,
+) -> dict:
+    _, parsed = store.nodes(source, url, force_refresh)
+    return process_singbox(
+        parsed,
+        config_param,
+        node_filter,
+        clean_node_fn,
+        shaping=SINGBOX_SHAPING.get(config_param, NO_SHAPING),
+    )
 
 
 def inject_custom_singbox_node(
-    json_str: str, node_path: Path, target_groups: list
-) -> str:
+    config: dict, node_path: Path, target_groups: list
+) -> dict:
+    # Works on the config in place: no serialize/parse round trip
     if not node_path.exists():
-        return json_str
+        return config
     try:
         with open(node_path, "r", encoding="utf-8") as f:
             custom_data = json.load(f)
-        if not custom_data:
-            return json_str
-        outbounds = custom_data if isinstance(custom_data, list) else [custom_data]
-        config = json.loads(json_str)
-        for outbound in outbounds:
-            if isinstance(outbound, dict) and "tag" in outbound:
-                node_tag = outbound["tag"]
-                config.setdefault("outbounds", []).append(outbound)
-                for cfg_outbound in config.get("outbounds", []):
-                    if cfg_outbound.get("tag") in target_groups and cfg_outbound.get(
-                        "type"
-                    ) in ["selector", "urltest"]:
-                        cfg_outbound.setdefault("outbounds", []).append(node_tag)
-        return json.dumps(config, ensure_ascii=False, separators=(",", ":"))
     except Exception as e:
         logger.error(f"[Sing-box] Inject Error: {e}")
-        return json_str
+        return config
+    if not custom_data:
+        return config
+
+    outbounds = custom_data if isinstance(custom_data, list) else [custom_data]
+    groups = [
+        o
+        for o in config.get("outbounds", [])
+        if o.get("tag") in target_groups and o.get("type") in ["selector", "urltest"]
+    ]
+    for outbound in outbounds:
+        if isinstance(outbound, dict) and "tag" in outbound:
+            config.setdefault("outbounds", []).append(outbound)
+            for group in groups:
+                group.setdefault("outbounds", []).append(outbound["tag"])
+    return config
+
+
+def dump_singbox(config: dict) -> bytes:
+    # The only serialization on the request path
+    if orjson is not None:
+        return orjson.dumps(config)
+    return json.dumps(config, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+SINGBOX_UA_MAP = {
+    "SFA": "mtun",
+    "sing-box_openwrt": "openwrt",
+    "sing-box_m": "m",
+    "sing-box_pc": "pc",
+}
+
+
+def profile_for(ua: str) -> Optional[str]:
+    return next((v for k, v in SINGBOX_UA_MAP.items() if k in ua), None)
+
+
+def render_config(
+    source,
+    profile,
+    load_nodes,
+    node_filter,
+    clean_fn,
+    custom_node_path,
+    target_groups,
+    inject_templates,
+    render_cache,
+) -> Rendered:
+    inject = profile in inject_templates
+    shaping = SINGBOX_SHAPING.get(profile, NO_SHAPING)
+    slot = (source, "singbox", profile)
+
+    source_hash, parsed = load_nodes()
+    base_key, cache_key = render_cache.make_keys(
+        slot,
+        source_hash,
+        files=[
+            Path(SB_TEMPLATE_MAP[profile]),
+            custom_node_path if inject else None,
+            *CODE_FILES,
+            __file__,
+            source_file(clean_fn),
+        ],
+        extra=[node_filter.include, node_filter.exclude, target_groups, shaping],
+    )
+    rendered = render_cache.get(slot, cache_key)
+    if rendered is not None:
+        return rendered
+
+    state = BUILDS.start(slot, base_key)
+    count("build", "incremental" if state.incremental else "full")
+    with stage("build"):
+        config = process_singbox(parsed, profile, node_filter, clean_fn, state, shaping)
+
+    if inject:
+        with stage("inject"):
+            config = inject_custom_singbox_node(config, custom_node_path, target_groups)
+
+    with stage("dump"):
+        data = dump_singbox(config)
+    BUILDS.commit(slot, state)
+    return render_cache.put(slot, cache_key, data)
 
 
 def handle_request(
     source,
-    url,
     ua,
     is_force_refresh,
-    cache_dir,
-    cache_expire,
-    shared_kw,
-    shared_ex_kw,
+    rebuild_nodes,
+    load_nodes,
+    node_filter,
     clean_fn,
     custom_node_path,
     target_groups,
     inject_templates,
+    render_cache,
 ):
-    singbox_ua_map = {
-        "SFA": "mtun",
-        "sing-box_openwrt": "openwrt",
-        "sing-box_m": "m",
-        "sing-box_pc": "pc",
-    }
-    config_val = next((v for k, v in singbox_ua_map.items() if k in ua), None)
+    config_val = profile_for(ua)
     if not config_val:
         return jsonify({"error": "No matching Sing-box UA"}), 404
+    slot = (source, "singbox", config_val)
 
     try:
-        json_str = fetch_and_process_singbox(
-            source,
-            config_val,
-            is_force_refresh,
-            url,
-            cache_dir,
-            cache_expire,
-            shared_kw,
-            shared_ex_kw,
-            clean_fn,
-        )
-
-        if config_val in inject_templates:
-            json_str = inject_custom_singbox_node(
-                json_str, custom_node_path, target_groups
+        published = render_cache.published(slot, "json")
+        if published and not (is_force_refresh or rebuild_nodes):
+            return render_cache.send_published(
+                published, "application/json", "config.json"
             )
 
-        return Response(
-            json_str,
-            mimetype="application/json",
-            headers={"Content-Disposition": "attachment; filename=config.json"},
+        rendered = render_cache.render(
+            slot,
+            lambda: render_config(
+                source,
+                config_val,
+                load_nodes,
+                node_filter,
+                clean_fn,
+                custom_node_path,
+                target_groups,
+                inject_templates,
+                render_cache,
+            ),
+            is_force_refresh,
+            rebuild_nodes,
         )
+
+        return render_cache.send(slot, rendered, "application/json", "config.json")
     except Exception as e:
         logger.error(f"Singbox Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def clone(data: Any) -> Any:
+    # Templates are plain YAML/JSON trees, so only dicts and lists need copying
+    if isinstance(data, dict):
+        return {k: clone(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [clone(i) for i in data]
+    return data
+
+
+class Template(NamedTuple):
+    data: dict
+    compiled: Any
+
+
+class TemplateRegistry:
+    """Parsed templates, loaded once and reloaded only when the mtime changes.
+
+    `loader` parses and validates a file, raising on a broken template; the
+    last good version keeps being served until the file is fixed.
+    `compile` derives per-template state (e.g. filter regexes) at load time.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[Path], dict],
+        compile: Optional[Callable[[dict], Any]] = None,
+    ):
+        self.loader = loader
+        self.compile = compile
+        self._entries: Dict[Path, Tuple[int, Template]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, path: Path) -> Template:
+        path = Path(path)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._entries.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == mtime:
+                return entry[1]
+            try:
+                data = self.loader(path)
+                compiled = self.compile(data) if self.compile else None
+                template = Template(data, compiled)
+                logger.info(f"Template loaded: {path}")
+            except Exception as e:
+                if not entry:
+                    raise
+                logger.error(f"Template reload failed, keeping old {path}: {e}")
+                # Pin the old data to the new mtime so we don't reparse per request
+                template = entry[1]
+            self._entries[path] = (mtime, template)
+            return template
+
+    def get(self, path: Path, mutable: Iterable[str] = ()) -> Template:
+        # Copy-on-write view: shared top level, private copies of `mutable` keys
+        template = self._load(path)
+        view = dict(template.data)
+        for key in mutable:
+            if key in view:
+                view[key] = clone(view[key])
+        return Template(view, template.compiled)
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+from flask import Flask, Response, g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a warm cache hit up to a slow cold upstream fetch
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """Per-process stage histograms and cache counters, in Prometheus text.
+
+    Each gunicorn worker keeps its own numbers; a scrape sees the worker
+    that answered it.
+    """
+
+    def __init__(self):
+        self._hist: Dict[str, List[int]] = {}
+        self._sum: Dict[str, float] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            counts = self._hist.setdefault(stage, [0] * (len(BUCKETS) + 1))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._sum[stage] = self._sum.get(stage, 0.0) + seconds
+
+    def inc(self, cache: str, result: str):
+        with self._lock:
+            key = (cache, result)
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            sums = dict(self._sum)
+            counters = dict(self._counters)
+
+        lines = [
+            "# HELP convert_stage_seconds Time spent per pipeline stage.",
+            "# TYPE convert_stage_seconds histogram",
+        ]
+        for stage in sorted(hist):
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), hist[stage]):
+                cumulative += count
+                lines.append(
+                    f'convert_stage_seconds_bucket{{stage="{stage}",le="{bound}"}}'
+                    f" {cumulative}"
+                )
+            lines.append(f'convert_stage_seconds_sum{{stage="{stage}"}} {sums[stage]}')
+            lines.append(f'convert_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        lines += [
+            "# HELP convert_cache_total Cache lookups by cache and result.",
+            "# TYPE convert_cache_total counter",
+        ]
+        for (cache, result), value in sorted(counters.items()):
+            lines.append(
+                f'convert_cache_total{{cache="{cache}",result="{result}"}} {value}'
+            )
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def stage(name: str):
+    # Records into the histograms, and into the current request if any
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe(name, elapsed)
+        if has_request_context():
+            g.setdefault("timings", []).append((name, elapsed))
+
+
+def count(cache: str, result: str):
+    METRICS.inc(cache, result)
+
+
+def init_app(
+    app: Flask, metrics_path: str = "/metrics", skip_paths: Iterable[str] = ()
+):
+    # skip_paths: not timed or logged (e.g. health checks)
+    skip = {metrics_path, *skip_paths}
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def emit_timings(response: Response) -> Response:
+        if request.path in skip or "request_start" not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        METRICS.observe("request", total)
+        timings = g.get("timings", [])
+
+        response.headers["Server-Timing"] = ", ".join(
+            [f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in timings]
+            + [f"total;dur={total * 1000:.2f}"]
+        )
+        fields = " ".join(
+            f"{name}_ms={elapsed * 1000:.2f}" for name, elapsed in timings
+        )
+        logger.info(
+            f"request path={request.path} status={response.status_code}"
+            f" total_ms={total * 1000:.2f} {fields}".rstrip()
+        )
+        return response
+
+    @app.route(metrics_path)
+    def metrics():
+        return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,330 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from render_cache import write_atomic
+from singleflight import SingleFlight
+from timing import count, stage
+from uri_parser import Node, iter_uri_lines, merge_nodes, parse_subscription
+
+logger = logging.getLogger(__name__)
+
+FETCH_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0"
+)
+FETCH_TIMEOUT = 15
+# Background refresh kicks in at this fraction of the expiry
+REFRESH_AHEAD = 0.8
+# After a failed fetch, the source is left alone this long (a good fetch
+# sets no backoff: stale-while-revalidate stays live)
+RETRY_BACKOFF = 60
+# Upper bound on providers fetched at once for a merged request
+FETCH_WORKERS = 8
+# Bump when the neutral node record layout changes
+NODES_FORMAT = 2
+
+
+def make_session() -> requests.Session:
+    # One keep-alive pool per process instead of a TCP+TLS handshake per fetch
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=1)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = FETCH_USER_AGENT
+    return session
+
+
+class SubscriptionStore:
+    """Raw base64 subscriptions cached as cache/{source}_uris.txt.
+
+    Requests are answered from the cached copy, even a stale one, while a
+    background thread refreshes it; only a cold cache or an explicit force
+    refresh waits for upstream. Concurrent refreshes of one source share a
+    single upstream call.
+
+    A second tier, cache/{source}_nodes.jsonl, keeps the parsed node records
+    tagged with the hash of the raw body they came from, so a hit skips
+    base64 decoding and URI parsing.
+    """
+
+    def __init__(self, cache_dir: Path, cache_expire: int):
+        self.cache_dir = cache_dir
+        self.cache_expire = cache_expire
+        self._flight = SingleFlight()
+        self._session = make_session()
+        self._nodes: Dict[str, Tuple[str, List[Node]]] = {}
+        self._merged: Dict[Tuple[str, ...], Tuple[str, List[Node]]] = {}
+        self._nodes_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix="fetch")
+
+    def cache_file(self, source: str) -> Path:
+        return self.cache_dir / f"{source}_uris.txt"
+
+    def _mtime(self, source: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.cache_file(source))
+        except OSError:
+            return None
+
+    def age(self, source: str) -> Optional[float]:
+        mtime = self._mtime(source)
+        return None if mtime is None else time.time() - mtime
+
+    def failed_file(self, source: str) -> Path:
+        # Touched on a failed fetch, removed on a good one; its mtime is the
+        # backoff every worker sharing cache_dir goes by
+        return self.cache_dir / f"{source}_uris.failed"
+
+    def _failed_at(self, source: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.failed_file(source))
+        except OSError:
+            return None
+
+    def meta_file(self, source: str) -> Path:
+        return self.cache_dir / f"{source}_uris.meta.json"
+
+    def _validators(self, source: str, url: str) -> Dict[str, str]:
+        # Only reuse validators recorded for the same URL and a cache that exists
+        if not self.cache_file(source).exists():
+            return {}
+        try:
+            with open(self.meta_file(source), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if meta.get("url") != url:
+            return {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def read(self, source: str) -> Optional[str]:
+        try:
+            with open(self.cache_file(source), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _fetch(self, source: str, url: str):
+        res = self._session.get(
+            url, headers=self._validators(source, url), timeout=FETCH_TIMEOUT
+        )
+        if res.status_code == 304:
+            # Unchanged upstream: just mark the cached copy fresh again
+            os.utime(self.cache_file(source))
+            logger.info(f"Subscription not modified: {source}")
+            return
+        res.raise_for_status()
+
+        # Bytes as sent: base64 is ASCII, no charset detection needed
+        raw_b64 = res.content.strip()
+        # Lazy: stops decoding lines at the first URI
+        if not any("://" in line for line in iter_uri_lines(raw_b64)):
+            raise ValueError("No valid protocol URIs found in decoded text")
+
+        # Save raw base64 to disk; readers never see a half-written file
+        write_atomic(self.cache_file(source), raw_b64)
+        meta = {
+            "url": url,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+        }
+        write_atomic(self.meta_file(source), json.dumps(meta).encode("utf-8"))
+        logger.info(f"Subscription refreshed: {source}")
+
+    def _refresh_once(self, source: str, url: str):
+        before = (self._mtime(source), self._failed_at(source))
+        try:
+            # Serialize refreshes across worker processes sharing cache_dir
+            with open(self.cache_dir / f"{source}_uris.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if (self._mtime(source), self._failed_at(source)) != before:
+                    # Another worker tried while we waited; its outcome stands
+                    return
+                try:
+                    self._fetch(source, url)
+                except Exception:
+                    self.failed_file(source).touch()
+                    raise
+                self.failed_file(source).unlink(missing_ok=True)
+        except Exception as e:
+            logger.error(f"Fetch Error [{source}]: {e}")
+
+    def refresh(self, source: str, url: str):
+        # Callers arriving mid-fetch wait for that fetch instead of starting one
+        self._flight.do(source, lambda: self._refresh_once(source, url))
+
+    def _backing_off(self, source: str) -> bool:
+        failed_at = self._failed_at(source)
+        return failed_at is not None and time.time() - failed_at < RETRY_BACKOFF
+
+    def refresh_async(self, source: str, url: str):
+        if self._flight.busy(source) or self._backing_off(source):
+            return
+        threading.Thread(target=self.refresh, args=(source, url), daemon=True).start()
+
+    def prefetch(self, sources: Dict[str, str]):
+        # Every source without a cached copy fetched once, in parallel; a
+        # failed one is then left alone for RETRY_BACKOFF by get(), in this
+        # worker and the others
+        cold = [
+            name
+            for name in sources
+            if self.age(name) is None and not self._backing_off(name)
+        ]
+        list(self._pool.map(lambda name: self.refresh(name, sources[name]), cold))
+
+    def get(self, source: str, url: str, force_refresh: bool = False) -> str:
+        age = self.age(source)
+        if force_refresh or (age is None and not self._backing_off(source)):
+            # No copy at all: a failing upstream is still retried at most
+            # once per RETRY_BACKOFF, not once per caller
+            self.refresh(source, url)
+        elif age is not None and age >= self.cache_expire:
+            # Stale-while-revalidate
+            self.refresh_async(source, url)
+
+        raw_b64 = self.read(source)
+        if raw_b64 is None:
+            raise RuntimeError("Fetch and cache failed")
+        return raw_b64
+
+    # ================= Parsed Node Tier =================
+    def nodes_file(self, source: str) -> Path:
+        return self.cache_dir / f"{source}_nodes.jsonl"
+
+    def _read_nodes(self, source: str, source_hash: str) -> Optional[List[Node]]:
+        # Layout: header line {"format", "source_hash"}, then one node per line
+        try:
+            with open(self.nodes_file(source), "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if header != {"format": NODES_FORMAT, "source_hash": source_hash}:
+                    return None
+                return [Node.from_dict(json.loads(line)) for line in f]
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write_nodes(self, source: str, source_hash: str, nodes: List[Node]):
+        header = {"format": NODES_FORMAT, "source_hash": source_hash}
+        lines = [json.dumps(header)]
+        lines += [
+            json.dumps(n.to_dict(), ensure_ascii=False, separators=(",", ":"))
+            for n in nodes
+        ]
+        try:
+            write_atomic(self.nodes_file(source), "\n".join(lines).encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"Node cache write failed [{source}]: {e}")
+
+    def nodes(
+        self, source: str, url: str, force_refresh: bool = False, rebuild: bool = False
+    ) -> Tuple[str, List[Node]]:
+        """Parsed nodes plus the hash of the raw body they came from.
+
+        The nodes are shared and must not be mutated. `rebuild` re-parses
+        the raw body even when the cached node list is current.
+        """
+        with stage("fetch"):
+            raw_b64 = self.get(source, url, force_refresh)
+        source_hash = hashlib.sha256(raw_b64.encode("utf-8")).hexdigest()
+
+        with self._nodes_lock:
+            hit = self._nodes.get(source)
+        if hit and hit[0] == source_hash and not rebuild:
+            count("nodes", "memory")
+            return hit
+
+        with stage("parse"):
+            nodes = None if rebuild else self._read_nodes(source, source_hash)
+            if nodes is not None:
+                count("nodes", "disk")
+            else:
+                count("nodes", "miss")
+                nodes = parse_subscription(raw_b64)
+                self._write_nodes(source, source_hash, nodes)
+                logger.info(f"Node cache rebuilt [{source}]: {len(nodes)} nodes")
+
+        with self._nodes_lock:
+            self._nodes[source] = (source_hash, nodes)
+        return source_hash, nodes
+
+    def merged_nodes(
+        self,
+        sources: Dict[str, str],
+        force_refresh: bool = False,
+        rebuild: bool = False,
+    ) -> Tuple[str, List[Node]]:
+        """Every provider in `sources` (name -> url) merged into one list.
+
+        Providers are loaded in parallel, so a cold merge waits for the
+        slowest upstream rather than the sum of them. A failed refresh falls
+        back to that provider's cached copy; a provider with no copy at all
+        is left out unless every provider failed.
+        """
+        # Pool threads record histograms only; the request sees "merge"
+        with stage("merge"):
+            return self._merge(sources, force_refresh, rebuild)
+
+    def _merge(
+        self, sources: Dict[str, str], force_refresh: bool, rebuild: bool
+    ) -> Tuple[str, List[Node]]:
+        futures = {
+            name: self._pool.submit(self.nodes, name, url, force_refresh, rebuild)
+            for name, url in sources.items()
+        }
+        digest = hashlib.sha256()
+        groups = []
+        for name, future in futures.items():
+            try:
+                source_hash, nodes = future.result()
+            except Exception as e:
+                logger.error(f"Merge skipped [{name}]: {e}")
+                continue
+            digest.update(f"{name}:{source_hash}\0".encode("utf-8"))
+            groups.append(nodes)
+
+        if not groups:
+            raise RuntimeError("Fetch and cache failed for every provider")
+
+        # Reuse the merge while no provider has changed
+        key, merged_hash = tuple(sources), digest.hexdigest()
+        with self._nodes_lock:
+            hit = self._merged.get(key)
+        if hit and hit[0] == merged_hash and not rebuild:
+            return hit
+        merged = (merged_hash, merge_nodes(groups))
+        with self._nodes_lock:
+            self._merged[key] = merged
+        return merged
+
+    def start_refresher(
+        self, sources: Dict[str, Callable[[], str]], interval: float = 300
+    ):
+        # sources: name -> function returning the current upstream URL
+        def loop():
+            while True:
+                for source, resolve_url in sources.items():
+                    age = self.age(source)
+                    if age is not None and age < self.cache_expire * REFRESH_AHEAD:
+                        continue
+                    try:
+                        self.refresh(source, resolve_url())
+                    except Exception as e:
+                        logger.error(f"Refresher Error [{source}]: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name="refresher", daemon=True).start()
@@ -0,0 +1,561 @@
+import base64
+import binascii
+import codecs
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_SIZE = 8
+SINGBOX_FINGERPRINT = "firefox"
+SINGBOX_HY2_MBPS = (50, 200)
+
+
+class Node:
+    """Protocol-neutral proxy node; unused fields stay None.
+
+    type      vless | vmess | trojan | hysteria2 | shadowsocks
+    ports     "20000-30000" port range (hysteria2), port is its first port
+    security  "" | tls | reality
+    network   tcp | ws | grpc
+    """
+
+    __slots__ = (
+        "type",
+        "name",
+        "server",
+        "port",
+        "ports",
+        "uuid",
+        "password",
+        "method",
+        "alter_id",
+        "flow",
+        "security",
+        "sni",
+        "fingerprint",
+        "pbk",
+        "sid",
+        "network",
+        "path",
+        "host",
+        "service_name",
+        "obfs",
+        "obfs_password",
+    )
+
+    def __init__(self, **fields: Any):
+        unknown = fields.keys() - set(self.__slots__)
+        if unknown:
+            raise TypeError(f"Unknown node fields: {sorted(unknown)}")
+        for slot in self.__slots__:
+            setattr(self, slot, fields.get(slot))
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Compact form for the on-disk node cache: unset fields are omitted
+        return {
+            slot: value
+            for slot in self.__slots__
+            if (value := getattr(self, slot)) is not None
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Node":
+        return cls(**data)
+
+    def copy(self, **changes: Any) -> "Node":
+        return Node(**{**self.to_dict(), **changes})
+
+    def key(self) -> Tuple[Any, ...]:
+        # Every field: equal keys convert to identical output
+        return _node_key(self)
+
+    def identity(self) -> Tuple[Any, Any, Any]:
+        # Same endpoint and credential means the same node, whatever its name
+        return (self.server, self.port, self.uuid or self.password)
+
+
+_node_key = attrgetter(*Node.__slots__)
+
+
+def b64decode_loose(s: str) -> str:
+    # urlsafe or standard alphabet, padding optional
+    s = s.strip().replace("-", "+").replace("_", "/")
+    s += "=" * ((4 - len(s) % 4) % 4)
+    return base64.b64decode(s).decode("utf-8")
+
+
+def split_netloc(netloc: str) -> Tuple[str, str, str]:
+    # -> (userinfo, host, port); keeps "a-b" port ranges that urlsplit rejects
+    userinfo, _, hostport = netloc.rpartition("@")
+    if hostport.startswith("["):
+        host, _, rest = hostport[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    else:
+        host, _, port = hostport.rpartition(":")
+        if not host:
+            host, port = port, ""
+    return unquote(userinfo), host, port
+
+
+def _first(qs: Dict[str, List[str]], key: str, default: Any = None) -> Any:
+    return qs.get(key, [default])[0]
+
+
+def _port_fields(port: str, default: int) -> Dict[str, Any]:
+    if "-" in port:
+        return {"port": int(port.split("-", 1)[0]), "ports": port}
+    return {"port": int(port) if port else default, "ports": None}
+
+
+# ================= Parsers =================
+def parse_vless(uri: str) -> Node:
+    parsed = urlsplit(uri)
+    uuid, server, port = split_netloc(parsed.netloc)
+    qs = parse_qs(parsed.query)
+    return Node(
+        type="vless",
+        name=unquote(parsed.fragment) if parsed.fragment else f"vless-{server}",
+        server=server,
+        **_port_fields(port, 443),
+        uuid=uuid,
+        flow=_first(qs, "flow") or None,
+        security=_first(qs, "security", ""),
+        sni=_first(qs, "sni"),
+        fingerprint=_first(qs, "fp"),
+        pbk=_first(qs, "pbk"),
+        sid=_first(qs, "sid"),
+        network=_first(qs, "type", "tcp"),
+        path=_first(qs, "path"),
+        host=_first(qs, "host"),
+        service_name=_first(qs, "serviceName"),
+    )
+
+
+def parse_vmess(uri: str) -> Node:
+    v = json.loads(b64decode_loose(uri[8:]))
+    server = v.get("add")
+    network = v.get("net") or "tcp"
+    return Node(
+        type="vmess",
+        name=unquote(v.get("ps", f"vmess-{server}")),
+        server=server,
+        port=int(v.get("port")),
+        uuid=v.get("id"),
+        alter_id=int(v.get("aid") or 0),
+        method=v.get("scy") or "auto",
+        security="tls" if v.get("tls") == "tls" else "",
+        sni=v.get("sni") or None,
+        fingerprint=v.get("fp") or None,
+        network=network,
+        path=v.get("path"),
+        host=v.get("host"),
+        service_name=v.get("path") if network == "grpc" else None,
+    )
+
+
+def _parse_password_uri(uri: str, p_type: str, default_port: int) -> Node:
+    parsed = urlsplit(uri)
+    password, server, port = split_netloc(parsed.netloc)
+    qs = parse_qs(parsed.query)
+    return Node(
+        type=p_type,
+        name=unquote(parsed.fragment) if parsed.fragment else f"proxy-{server}",
+        server=server,
+        **_port_fields(port, default_port),
+        password=password,
+        security="tls",
+        sni=_first(qs, "sni"),
+        network=_first(qs, "type", "tcp"),
+        path=_first(qs, "path"),
+        host=_first(qs, "host"),
+        service_name=_first(qs, "serviceName"),
+        obfs=_first(qs, "obfs"),
+        obfs_password=_first(qs, "obfs-password"),
+    )
+
+
+def parse_trojan(uri: str) -> Node:
+    return _parse_password_uri(uri, "trojan", 443)
+
+
+def parse_hy2(uri: str) -> Node:
+    return _parse_password_uri(uri, "hysteria2", 443)
+
+
+def parse_ss(uri: str) -> Node:
+    body, _, name = uri[5:].partition("#")
+    body = body.split("?", 1)[0].rstrip("/")
+    if "@" in body:
+        # SIP002: base64(method:password)@host:port, or plain userinfo
+        userinfo, host_part = body.rsplit("@", 1)
+        userinfo = unquote(userinfo)
+        if ":" not in userinfo:
+            userinfo = b64decode_loose(userinfo)
+    else:
+        # Legacy: base64(method:password@host:port)
+        userinfo, host_part = b64decode_loose(body).rsplit("@", 1)
+    method, password = userinfo.split(":", 1)
+    _, server, port = split_netloc(host_part)
+    return Node(
+        type="shadowsocks",
+        name=unquote(name) if name else f"ss-{server}",
+        server=server,
+        port=int(port),
+        method=method,
+        password=password,
+    )
+
+
+PARSERS = {
+    "vless://": parse_vless,
+    "vmess://": parse_vmess,
+    "trojan://": parse_trojan,
+    "hysteria2://": parse_hy2,
+    "hy2://": parse_hy2,
+    "ss://": parse_ss,
+}
+
+
+def parse_uri(uri: str) -> Optional[Node]:
+    scheme = uri[: uri.find("://") + 3]
+    parser = PARSERS.get(scheme)
+    if not parser:
+        return None
+    try:
+        return parser(uri)
+    except Exception as e:
+        logger.warning(f"Parse Error for node {uri[:30]}...: {e}")
+        return None
+
+
+# ================= Subscription Body =================
+# One translate() pass: urlsafe alphabet to standard, whitespace removed
+_B64_TABLE = bytes.maketrans(b"-_", b"+/")
+_B64_WHITESPACE = b" \t\r\n\x0b\x0c"
+_LINE = re.compile(rb"[^\r\n]+")
+
+
+def iter_uri_lines(raw_b64: Union[str, bytes]) -> Iterator[str]:
+    """Base64 subscription body -> its non-empty lines, decoded lazily.
+
+    Accepts either base64 alphabet, wrapped lines and missing padding.
+    The body is decoded once as bytes; lines are cut and turned into str
+    one at a time as the consumer asks for them.
+    """
+    if isinstance(raw_b64, str):
+        raw_b64 = raw_b64.encode("ascii", errors="ignore")
+    data = raw_b64.translate(_B64_TABLE, _B64_WHITESPACE)
+    if len(data) % 4:
+        data += b"=" * (-len(data) % 4)
+    decoded = binascii.a2b_base64(data)
+
+    # UTF-8 multibyte sequences never contain CR/LF bytes, so splitting the
+    # bytes before decoding each line is safe
+    start = len(codecs.BOM_UTF8) if decoded.startswith(codecs.BOM_UTF8) else 0
+    for m in _LINE.finditer(decoded, start):
+        line = m.group().strip()
+        if line:
+            yield line.decode("utf-8", errors="ignore")
+
+
+_parse_cache: "OrderedDict[bytes, List[Node]]" = OrderedDict()
+_parse_lock = threading.Lock()
+
+
+def parse_subscription(raw_b64: Union[str, bytes]) -> List[Node]:
+    """Base64 subscription body -> neutral nodes, parsed once per body.
+
+    The returned nodes are shared between callers and must not be
+    mutated; the serializers below build fresh per-target dicts.
+    """
+    if isinstance(raw_b64, str):
+        raw_b64 = raw_b64.encode("ascii", errors="ignore")
+    digest = hashlib.sha256(raw_b64).digest()
+    with _parse_lock:
+        nodes = _parse_cache.get(digest)
+        if nodes is not None:
+            _parse_cache.move_to_end(digest)
+            return nodes
+
+    nodes = [node for line in iter_uri_lines(raw_b64) if (node := parse_uri(line))]
+
+    with _parse_lock:
+        _parse_cache[digest] = nodes
+        while len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return nodes
+
+
+def merge_nodes(groups: Iterable[List[Node]]) -> List[Node]:
+    """Concatenate provider node lists in order.
+
+    Later duplicates of an endpoint are dropped; a node whose name is
+    already taken is renamed "name 2", "name 3", ... (as a copy, since the
+    input nodes are shared).
+    """
+    seen = set()
+    names = set()
+    merged = []
+    for nodes in groups:
+        for node in nodes:
+            ident = node.identity()
+            if ident in seen:
+                continue
+            seen.add(ident)
+            name, n = node.name, 2
+            while name in names:
+                name, n = f"{node.name} {n}", n + 1
+            if name != node.name:
+                node = node.copy(name=name)
+            names.add(name)
+            merged.append(node)
+    return merged
+
+
+def unique_names(entries: List[dict], field: str) -> List[dict]:
+    """Emitted entries with their `field` made unique, after name cleaning.
+
+    Cleaning can turn distinct names into one ("🇭🇰 香港 01", "HK 01"), and
+    clients reject duplicate names or tags. Later duplicates are renamed
+    "name 2", "name 3", ... (as copies: entries may be shared with the
+    build state).
+    """
+    names = set()
+    unique = []
+    for entry in entries:
+        name, n = entry.get(field), 2
+        while name and name in names:
+            name, n = f"{entry[field]} {n}", n + 1
+        if name != entry.get(field):
+            entry = type(entry)(entry)
+            entry[field] = name
+        names.add(name)
+        unique.append(entry)
+    return unique
+
+
+# ================= Clash Serializers =================
+Serializer = Callable[[Node], Dict[str, Any]]
+
+
+def _clash_transport(node: Node, proxy: dict):
+    network = node.network or "tcp"
+    proxy["network"] = network
+    if network == "ws":
+        proxy["ws-opts"] = {
+            "path": node.path or "/",
+            "headers": {"Host": node.host or node.server},
+        }
+    elif network == "grpc":
+        proxy["grpc-opts"] = {"grpc-service-name": node.service_name or ""}
+
+
+def clash_vless(node: Node) -> dict:
+    proxy = {
+        "name": node.name,
+        "type": "vless",
+        "server": node.server,
+        "port": node.port,
+        "uuid": node.uuid,
+        "udp": True,
+        "tls": node.security in ("tls", "reality"),
+    }
+    if node.flow:
+        proxy["flow"] = node.flow
+    if proxy["tls"]:
+        proxy["servername"] = node.sni or node.server
+        if node.fingerprint:
+            proxy["client-fingerprint"] = node.fingerprint
+        if node.security == "reality":
+            proxy["reality-opts"] = {"public-key": node.pbk or ""}
+            if node.sid is not None:
+                proxy["reality-opts"]["short-id"] = node.sid
+    _clash_transport(node, proxy)
+    return proxy
+
+
+def clash_vmess(node: Node) -> dict:
+    proxy = {
+        "name": node.name,
+        "type": "vmess",
+        "server": node.server,
+        "port": node.port,
+        "uuid": node.uuid,
+        "alterId": node.alter_id,
+        "cipher": node.method,
+        "udp": True,
+    }
+    if node.security == "tls":
+        proxy["tls"] = True
+        if node.sni:
+            proxy["servername"] = node.sni
+        if node.fingerprint:
+            proxy["client-fingerprint"] = node.fingerprint
+    _clash_transport(node, proxy)
+    return proxy
+
+
+def clash_password(node: Node) -> dict:
+    # trojan and hysteria2 share the URI layout
+    proxy = {
+        "name": node.name,
+        "type": node.type,
+        "server": node.server,
+        "port": node.port,
+        "password": node.password,
+        "udp": True,
+    }
+    if node.ports:
+        proxy["ports"] = node.ports
+    if node.sni:
+        proxy["sni"] = node.sni
+    if node.type == "hysteria2":
+        if node.obfs:
+            proxy["obfs"] = node.obfs
+        if node.obfs_password:
+            proxy["obfs-password"] = node.obfs_password
+    return proxy
+
+
+def clash_ss(node: Node) -> dict:
+    return {
+        "name": node.name,
+        "type": "ss",
+        "server": node.server,
+        "port": node.port,
+        "cipher": node.method,
+        "password": node.password,
+        "udp": True,
+    }
+
+
+CLASH_EMITTERS: Dict[str, Serializer] = {
+    "vless": clash_vless,
+    "vmess": clash_vmess,
+    "trojan": clash_password,
+    "hysteria2": clash_password,
+    "shadowsocks": clash_ss,
+}
+
+
+# ================= Sing-box Serializers =================
+def _singbox_transport(node: Node, outbound: dict):
+    network = node.network or "tcp"
+    if network == "ws":
+        outbound["transport"] = {"type": "ws", "path": node.path or "/"}
+        if node.host:
+            outbound["transport"]["headers"] = {"Host": node.host}
+    elif network == "grpc":
+        outbound["transport"] = {
+            "type": "grpc",
+            "service_name": node.service_name or "",
+        }
+
+
+def _singbox_tls(node: Node) -> dict:
+    return {
+        "enabled": True,
+        "server_name": node.sni or "",
+        "utls": {"enabled": True, "fingerprint": SINGBOX_FINGERPRINT},
+    }
+
+
+def singbox_vless(node: Node) -> dict:
+    outbound = {
+        "type": "vless",
+        "tag": node.name,
+        "server": node.server,
+        "server_port": node.port,
+        "uuid": node.uuid,
+    }
+    if node.flow:
+        outbound["flow"] = node.flow
+    if node.security in ("tls", "reality"):
+        tls = _singbox_tls(node)
+        if node.security == "reality":
+            tls["reality"] = {
+                "enabled": True,
+                "public_key": node.pbk or "",
+                "short_id": node.sid or "",
+            }
+        outbound["tls"] = tls
+    _singbox_transport(node, outbound)
+    return outbound
+
+
+def singbox_vmess(node: Node) -> dict:
+    outbound = {
+        "type": "vmess",
+        "tag": node.name,
+        "server": node.server,
+        "server_port": node.port,
+        "uuid": node.uuid,
+        "security": node.method,
+        "alter_id": node.alter_id,
+    }
+    if node.security == "tls":
+        outbound["tls"] = _singbox_tls(node)
+    _singbox_transport(node, outbound)
+    return outbound
+
+
+def singbox_trojan(node: Node) -> dict:
+    outbound = {
+        "type": "trojan",
+        "tag": node.name,
+        "server": node.server,
+        "server_port": node.port,
+        "password": node.password,
+        "tls": {"enabled": True, "server_name": node.sni or ""},
+    }
+    _singbox_transport(node, outbound)
+    return outbound
+
+
+def singbox_hy2(node: Node) -> dict:
+    outbound = {"type": "hysteria2", "tag": node.name, "server": node.server}
+    if node.ports:
+        outbound["server_ports"] = node.ports.replace("-", ":")
+    else:
+        outbound["server_port"] = node.port
+    outbound["up_mbps"], outbound["down_mbps"] = SINGBOX_HY2_MBPS
+    if node.obfs:
+        outbound["obfs"] = {
+            "type": node.obfs,
+            "password": node.obfs_password or "",
+        }
+    outbound["password"] = node.password
+    outbound["tls"] = {"enabled": True, "server_name": node.sni or ""}
+    return outbound
+
+
+def singbox_ss(node: Node) -> dict:
+    return {
+        "type": "shadowsocks",
+        "tag": node.name,
+        "server": node.server,
+        "server_port": node.port,
+        "method": node.method,
+        "password": node.password,
+    }
+
+
+SINGBOX_EMITTERS: Dict[str, Serializer] = {
+    "vless": singbox_vless,
+    "vmess": singbox_vmess,
+    "trojan": singbox_trojan,
+    "hysteria2": singbox_hy2,
+    "shadowsocks": singbox_ss,
+}
+
+
+def emit(nodes: List[Node], emitters: Dict[str, Serializer]) -> List[dict]:
+    return [emitters[n.type](n) for n in nodes if n.type in emitters]